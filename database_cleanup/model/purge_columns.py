@@ -38,33 +38,43 @@ class CleanupPurgeLineColumn(orm.TransientModel):
     def purge(self, cr, uid, ids, context=None):
         """
         Unlink columns upon manual confirmation.
+
+        The columns to drop are grouped per table, and every table
+        is altered once, in its own transaction, to keep exclusive locks
+        short. See set_lock_timeout.
         """
+        table2lines = {}
         for line in self.browse(cr, uid, ids, context=context):
             if line.purged:
                 continue
-
-            model_pool = self.pool[line.model_id.model]
-
-            # Check whether the column actually still exists.
-            # Inheritance such as stock.picking.in from stock.picking
-            # can lead to double attempts at removal
-            cr.execute(
-                'SELECT count(attname) FROM pg_attribute '
-                'WHERE attrelid = '
-                '( SELECT oid FROM pg_class WHERE relname = %s ) '
-                'AND attname = %s',
-                (model_pool._table, line.name))
-            if not cr.fetchone()[0]:
+            table = self.pool[line.model_id.model]._table
+            table2lines.setdefault(table, []).append(line)
+
+        # Check whether the columns actually still exist.
+        # Inheritance such as stock.picking.in from stock.picking
+        # can lead to double attempts at removal
+        table_columns = self.pool['cleanup.purge.wizard.column']\
+            .get_table_columns(cr, uid, table2lines.keys(), context=context)
+
+        for table, lines in sorted(table2lines.iteritems()):
+            lines = [
+                line for line in lines if line.name in table_columns[table]]
+            if not lines:
                 continue
-
+            columns = sorted(set(line.name for line in lines))
             self.logger.info(
-                'Dropping column %s from table %s',
-                line.name, model_pool._table)
-            cr.execute(
-                """
-                ALTER TABLE "%s" DROP COLUMN "%s"
-                """ % (model_pool._table, line.name))
-            line.write({'purged': True})
+                'Dropping columns %s from table %s',
+                ', '.join(columns), table)
+            self.set_lock_timeout(cr, uid, context=context)
+            self.execute_ddl(
+                cr, uid,
+                'ALTER TABLE "%s" %s' % (
+                    table, ', '.join(
+                        'DROP COLUMN "%s"' % column for column in columns)),
+                [table], context=context)
+            self.write(
+                cr, uid, [line.id for line in lines], {'purged': True},
+                context=context)
             cr.commit()
         return True
 
@@ -86,32 +96,56 @@ class CleanupPurgeWizardColumn(orm.TransientModel):
             res['name'] = _('Purge columns')
         return res
 
-    def get_orphaned_columns(self, cr, uid, model_pools, context=None):
+    def get_expected_columns(self, cr, uid, model_pools, context=None):
         """
-        From openobject-server/openerp/osv/orm.py
-        Iterate on the database columns to identify columns
-        of fields which have been removed
+        Return the set of columns the models sharing a table expect,
+        including magic columns and blacklisted columns
         """
-
-        columns = list(set([
+        columns = set([
             column for model_pool in model_pools
             for column in model_pool._columns
             if not (isinstance(model_pool._columns[column], fields.function)
                     and not model_pool._columns[column].store)
-            ]))
-        columns += orm.MAGIC_COLUMNS
-        columns += self.blacklist.get(model_pools[0]._table, [])
+            ])
+        columns.update(orm.MAGIC_COLUMNS)
+        columns.update(self.blacklist.get(model_pools[0]._table, []))
+        return columns
 
-        cr.execute("SELECT a.attname"
+    def get_table_columns(self, cr, uid, tables, context=None):
+        """
+        Return a mapping of each of the tables to the list of its
+        columns, using a single catalog query for all of them
+        """
+        res = dict((table, []) for table in tables)
+        if not tables:
+            return res
+        cr.execute("SELECT c.relname, a.attname"
                    "  FROM pg_class c, pg_attribute a"
-                   " WHERE c.relname=%s"
+                   " WHERE c.relname IN %s"
                    "   AND c.oid=a.attrelid"
                    "   AND a.attisdropped=%s"
                    "   AND pg_catalog.format_type(a.atttypid, a.atttypmod)"
                    "        NOT IN ('cid', 'tid', 'oid', 'xid')"
-                   "   AND a.attname NOT IN %s",
-                   (model_pools[0]._table, False, tuple(columns))),
-        return [column[0] for column in cr.fetchall()]
+                   " ORDER BY c.relname, a.attnum",
+                   (tuple(tables), False))
+        for table, column in cr.fetchall():
+            if column not in res[table]:
+                res[table].append(column)
+        return res
+
+    def get_orphaned_columns(self, cr, uid, model_pools, context=None):
+        """
+        From openobject-server/openerp/osv/orm.py
+        Iterate on the database columns to identify columns
+        of fields which have been removed
+        """
+        table = model_pools[0]._table
+        expected = self.get_expected_columns(
+            cr, uid, model_pools, context=context)
+        return [
+            column for column in self.get_table_columns(
+                cr, uid, [table], context=context)[table]
+            if column not in expected]
 
     def find(self, cr, uid, context=None):
         """
@@ -120,6 +154,9 @@ class CleanupPurgeWizardColumn(orm.TransientModel):
         Group models by table to prevent false positives for columns
         that are only in some of the models sharing the same table.
         Example of this is 'sale_id' not being a field of stock.picking.in
+
+        The columns of all tables are read with one query and compared
+        to the models' fields in memory.
         """
         res = []
         model_pool = self.pool['ir.model']
@@ -135,9 +172,14 @@ class CleanupPurgeWizardColumn(orm.TransientModel):
             table2model.setdefault(
                 model_pool._table, (model.id, []))[1].append(model_pool)
 
-        for table, model_spec in table2model.iteritems():
-            for column in self.get_orphaned_columns(
-                    cr, uid, model_spec[1], context=context):
+        table_columns = self.get_table_columns(
+            cr, uid, table2model.keys(), context=context)
+        for table, model_spec in sorted(table2model.iteritems()):
+            expected = self.get_expected_columns(
+                cr, uid, model_spec[1], context=context)
+            for column in table_columns[table]:
+                if column in expected:
+                    continue
                 res.append((0, 0, {
                             'name': column,
                             'model_id': model_spec[0]}))
@@ -35,49 +35,69 @@ class CleanupPurgeLineTable(orm.TransientModel):
     def purge(self, cr, uid, ids, context=None):
         """
         Unlink tables upon manual confirmation.
+
+        The constraints of all tables are retrieved at once, and the
+        tables are dropped in a single transaction. See set_lock_timeout.
         """
         lines = self.browse(cr, uid, ids, context=context)
         tables = [line.name for line in lines]
-        for line in lines:
-            if line.purged:
-                continue
-
-            # Retrieve constraints on the tables to be dropped
-            # This query is referenced in numerous places
-            # on the Internet but credits probably go to Tom Lane
-            # in this post http://www.postgresql.org/\
-            # message-id/22895.1226088573@sss.pgh.pa.us
-            # Only using the constraint name and the source table,
-            # but I'm leaving the rest in for easier debugging
-            cr.execute(
-                """
-                SELECT conname, confrelid::regclass, af.attname AS fcol,
-                    conrelid::regclass, a.attname AS col
-                FROM pg_attribute af, pg_attribute a,
-                    (SELECT conname, conrelid, confrelid,conkey[i] AS conkey,
-                         confkey[i] AS confkey
-                     FROM (select conname, conrelid, confrelid, conkey,
-                       confkey, generate_series(1,array_upper(conkey,1)) AS i
-                       FROM pg_constraint WHERE contype = 'f') ss) ss2
-                WHERE af.attnum = confkey AND af.attrelid = confrelid AND
-                a.attnum = conkey AND a.attrelid = conrelid
-                AND confrelid::regclass = '%s'::regclass;
-                """ % line.name)
-
-            for constraint in cr.fetchall():
-                if constraint[3] in tables:
-                    self.logger.info(
-                        'Dropping constraint %s on table %s (to be dropped)',
-                        constraint[0], constraint[3])
-                    cr.execute(
-                        "ALTER TABLE %s DROP CONSTRAINT %s" % (
-                            constraint[3], constraint[0]))
-
+        lines = [line for line in lines if not line.purged]
+        if not lines:
+            return True
+
+        # Retrieve constraints on the tables to be dropped
+        # This query is referenced in numerous places
+        # on the Internet but credits probably go to Tom Lane
+        # in this post http://www.postgresql.org/\
+        # message-id/22895.1226088573@sss.pgh.pa.us
+        # Only using the constraint name and the source table,
+        # but I'm leaving the rest in for easier debugging
+        cr.execute(
+            """
+            SELECT conname, confrelid::regclass, af.attname AS fcol,
+                conrelid::regclass, a.attname AS col
+            FROM pg_attribute af, pg_attribute a,
+                (SELECT conname, conrelid, confrelid,conkey[i] AS conkey,
+                     confkey[i] AS confkey
+                 FROM (select conname, conrelid, confrelid, conkey,
+                   confkey, generate_series(1,array_upper(conkey,1)) AS i
+                   FROM pg_constraint WHERE contype = 'f') ss) ss2
+            WHERE af.attnum = confkey AND af.attrelid = confrelid AND
+            a.attnum = conkey AND a.attrelid = conrelid
+            AND confrelid = ANY(%s::regclass[]);
+            """, ([line.name for line in lines],))
+
+        # mapping of tables to the constraints to drop from them
+        table2constraints = {}
+        for constraint in cr.fetchall():
+            if constraint[3] in tables:
+                constraints = table2constraints.setdefault(constraint[3], [])
+                if constraint[0] not in constraints:
+                    constraints.append(constraint[0])
+
+        self.set_lock_timeout(cr, uid, context=context)
+        for table, constraints in sorted(table2constraints.iteritems()):
             self.logger.info(
-                'Dropping table %s', line.name)
-            cr.execute("DROP TABLE \"%s\"" % (line.name,))
-            line.write({'purged': True})
-            cr.commit()
+                'Dropping constraints %s on table %s (to be dropped)',
+                ', '.join(constraints), table)
+            self.execute_ddl(
+                cr, uid,
+                "ALTER TABLE %s %s" % (
+                    table, ', '.join(
+                        'DROP CONSTRAINT %s' % constraint
+                        for constraint in constraints)),
+                [table], context=context)
+
+        names = [line.name for line in lines]
+        self.logger.info('Dropping tables %s', ', '.join(names))
+        self.execute_ddl(
+            cr, uid,
+            "DROP TABLE %s" % ', '.join('"%s"' % name for name in names),
+            names, context=context)
+        self.write(
+            cr, uid, [line.id for line in lines], {'purged': True},
+            context=context)
+        cr.commit()
         return True
 
 
@@ -20,7 +20,9 @@
 ##############################################################################
 
 import logging
+from psycopg2 import OperationalError, errorcodes
 from openerp.osv import orm, fields
+from openerp.tools.translate import _
 
 
 class CleanupPurgeLine(orm.AbstractModel):
@@ -36,6 +38,33 @@ class CleanupPurgeLine(orm.AbstractModel):
     def purge(self, cr, uid, ids, context=None):
         raise NotImplementedError
 
+    def set_lock_timeout(self, cr, uid, context=None):
+        """
+        Limit the time the current transaction waits for locks to the
+        value of the system parameter database_cleanup.lock_timeout,
+        in milliseconds or with a unit, i.e. '5s'. No limit if unset.
+        """
+        lock_timeout = self.pool['ir.config_parameter'].get_param(
+            cr, uid, 'database_cleanup.lock_timeout', context=context)
+        if lock_timeout:
+            cr.execute('SET LOCAL lock_timeout = %s', (lock_timeout,))
+
+    def execute_ddl(self, cr, uid, query, tables, context=None):
+        """
+        Execute a DDL statement on tables. If a lock on them cannot be
+        obtained within the lock timeout, roll back and tell the user
+        """
+        try:
+            cr.execute(query)
+        except OperationalError as e:
+            if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE:
+                raise
+            cr.rollback()
+            raise orm.except_orm(
+                _('Table locked'),
+                _('Could not lock table(s) %s within the lock timeout, '
+                  'please try again later.') % ', '.join(tables))
+
 
 class PurgeWizard(orm.AbstractModel):
     """ Abstract base class for the purge wizards """
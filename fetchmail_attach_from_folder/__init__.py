@@ -20,6 +20,7 @@
 #
 ##############################################################################
 
+from . import controllers
 from . import match_algorithm
 from . import model
 from . import wizard
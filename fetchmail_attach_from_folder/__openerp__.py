@@ -23,13 +23,14 @@
 {
     'name': 'Email gateway - folders',
     'summary': 'Attach mails in an IMAP folder to existing objects',
-    'version': '1.0',
+    'version': '1.1',
     'author': 'Therp BV',
     'website': 'http://www.therp.nl',
     'license': 'AGPL-3',
     "category": "Tools",
     "depends": ['fetchmail'],
     'data': [
+        'data/ir_config_parameter.xml',
         'view/fetchmail_server.xml',
         'wizard/attach_mail_manually.xml',
         'security/ir.model.access.csv',
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import hmac
+import openerp
+from openerp import SUPERUSER_ID, http
+from openerp.http import request
+import werkzeug
+
+
+class metrics(http.Controller):
+    @http.route('/fetchmail_attach_from_folder/metrics', type='http',
+                auth='none')
+    def metrics(self, db=None, token=None, **kwargs):
+        '''Statistics of the last folder runs for a metrics scraper. Pass
+        the system parameter fetchmail_attach_from_folder.metrics_token as
+        token or as bearer token, the endpoint is disabled without it'''
+        db = db or request.db
+        # don't load registries of databases hidden by dbfilter or missing
+        if not db or not http.db_filter([db]) or\
+                db not in http.db_list(force=True):
+            return werkzeug.exceptions.NotFound()
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if not token and authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        registry = openerp.registry(db)
+        if 'fetchmail.server.folder' not in registry:
+            return werkzeug.exceptions.NotFound()
+        with registry.cursor() as cr:
+            expected = registry['ir.config_parameter'].get_param(
+                cr, SUPERUSER_ID,
+                'fetchmail_attach_from_folder.metrics_token')
+            if not expected or not token or\
+                    not hmac.compare_digest(str(expected), str(token)):
+                return werkzeug.exceptions.NotFound()
+            result = registry['fetchmail.server.folder'].get_metrics(
+                cr, SUPERUSER_ID)
+        return request.make_response(
+            result, [('Content-Type', 'text/plain; version=0.0.4')])
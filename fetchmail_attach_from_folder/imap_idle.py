@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''Threads waiting for new mail with IMAP IDLE'''
+import logging
+import threading
+from openerp import api, registry
+from .imap_utils import idle
+_logger = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 29 * 60
+'''RFC 2177 asks clients to restart IDLE at least every 29 minutes'''
+
+RETRY_DELAY = 60
+'''Seconds to wait before reconnecting after an error'''
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+class idle_listener(threading.Thread):
+    '''Keeps a connection to a folder's server in IDLE state and handles the
+    folder as soon as the server reports new messages. Stops when the
+    folder is deleted or push mode is switched off'''
+
+    def __init__(self, dbname, uid, folder_id):
+        super(idle_listener, self).__init__(
+            name='fetchmail_idle_%s_%d' % (dbname, folder_id))
+        self.daemon = True
+        self.dbname = dbname
+        self.uid = uid
+        self.folder_id = folder_id
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _with_folder(self, function):
+        '''Call function with the folder in a new transaction and return its
+        result. Return False if the folder doesn't want push mode anymore'''
+        with api.Environment.manage():
+            with registry(self.dbname).cursor() as cr:
+                env = api.Environment(cr, self.uid, {})
+                folder = env['fetchmail.server.folder'].browse(self.folder_id)
+                if not folder.exists() or not folder.idle or\
+                        not folder.server_id.active:
+                    return False
+                return function(folder.with_context(
+                    fetchmail_server_id=folder.server_id.id,
+                    server_type=folder.server_id.type))
+
+    def _connect(self, folder):
+        connection = folder.server_id.connect()
+        if connection.select(folder.path)[0] != 'OK':
+            connection.logout()
+            raise Exception('Could not open mailbox %s' % folder.path)
+        return connection
+
+    def _handle(self, folder, connection):
+        folder.server_id.handle_folder(connection, folder)
+        return True
+
+    def run(self):
+        connection = None
+        while not self.stopped.is_set():
+            try:
+                if connection is None:
+                    connection = self._with_folder(self._connect)
+                    if not connection:
+                        break
+                    if not self._with_folder(
+                            lambda folder: self._handle(folder, connection)):
+                        break
+                if idle(connection, IDLE_TIMEOUT) and not\
+                        self.stopped.is_set():
+                    if not self._with_folder(
+                            lambda folder: self._handle(folder, connection)):
+                        break
+            except Exception:
+                _logger.exception(
+                    'Error waiting for mail in folder %d', self.folder_id)
+                if connection:
+                    try:
+                        connection.logout()
+                    except Exception:
+                        pass
+                connection = None
+                self.stopped.wait(RETRY_DELAY)
+        if connection:
+            try:
+                connection.logout()
+            except Exception:
+                pass
+        with _listeners_lock:
+            if _listeners.get((self.dbname, self.folder_id)) is self:
+                del _listeners[(self.dbname, self.folder_id)]
+
+
+def ensure_listener(dbname, uid, folder_id):
+    '''Start a listener for a folder unless one runs already in this
+    process'''
+    with _listeners_lock:
+        listener = _listeners.get((dbname, folder_id))
+        if listener is not None and listener.is_alive():
+            return listener
+        listener = idle_listener(dbname, uid, folder_id)
+        _listeners[(dbname, folder_id)] = listener
+    listener.start()
+    return listener
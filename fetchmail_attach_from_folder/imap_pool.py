@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''Process wide pool of authenticated IMAP connections'''
+import logging
+import threading
+from contextlib import contextmanager
+_logger = logging.getLogger(__name__)
+
+
+class connection_pool(object):
+    '''Keeps logged in IMAP connections per fetchmail.server for reuse.
+    A connection is only ever handed out to one user at a time'''
+
+    max_idle = 4
+    '''Connections to keep per server'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+        self.logins = 0
+
+    def _key(self, server):
+        '''Connections are only reused if none of the server's connection
+        settings changed'''
+        return (
+            server.env.cr.dbname, server.id, server.server, server.port,
+            server.is_ssl, server.user, server.password)
+
+    def acquire(self, server):
+        '''Return a logged in connection for server'''
+        key = self._key(server)
+        while True:
+            with self._lock:
+                connections = self._connections.get(key)
+                connection = connections.pop() if connections else None
+            if connection is None:
+                break
+            try:
+                if connection.noop()[0] == 'OK':
+                    return connection
+            except Exception:
+                pass
+            self.discard(connection)
+        with self._lock:
+            self.logins += 1
+        return server.connect()
+
+    def release(self, server, connection):
+        '''Give connection back to the pool. A selected mailbox is closed,
+        which expunges messages flagged as deleted'''
+        try:
+            if connection.state == 'SELECTED':
+                connection.close()
+        except Exception:
+            _logger.exception('Could not close mailbox on %s', server.server)
+            return self.discard(connection)
+        key = self._key(server)
+        with self._lock:
+            connections = self._connections.setdefault(key, [])
+            if connection.state == 'AUTH' and\
+                    len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        '''Log out connection without putting it back'''
+        try:
+            connection.logout()
+        except Exception:
+            pass
+
+    def clear(self, server=None):
+        '''Log out idle connections of server, or all if server is None'''
+        with self._lock:
+            if server is None:
+                keys = self._connections.keys()
+            else:
+                keys = [
+                    key for key in self._connections
+                    if key[:2] == self._key(server)[:2]]
+            connections = sum(
+                [self._connections.pop(key) for key in keys], [])
+        for connection in connections:
+            self.discard(connection)
+
+    @contextmanager
+    def connection(self, server):
+        '''Context manager acquiring a connection and releasing it
+        afterwards. Connections that raised are not reused'''
+        connection = self.acquire(server)
+        try:
+            yield connection
+        except Exception:
+            self.discard(connection)
+            raise
+        self.release(server, connection)
+
+
+pool = connection_pool()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''Helpers for talking to IMAP servers in batches'''
+import re
+import select
+import time
+
+FETCH_HEADER = re.compile(r'^(?P<seq>\d+) \((?P<items>.*)$')
+FETCH_UID = re.compile(r'\bUID (?P<uid>\d+)')
+FETCH_SIZE = re.compile(r'\bRFC822\.SIZE (?P<size>\d+)')
+IDLE_EXISTS = re.compile(r'^\* \d+ (EXISTS|RECENT)\b')
+SEXP_TOKEN = re.compile(
+    r'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|'
+    r'\{(?P<literal>\d+)\}|'
+    r'(?P<atom>[^\s()"{\[]+(?:\[[^\]]*\][^\s()"{]*)?))')
+
+
+def chunked(iterable, size):
+    '''Yield lists of at most size elements from iterable'''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def chunked_by_size(msgids, size, budget, sizes):
+    '''Yield lists of at most size msgids whose sizes add up to at most
+    budget bytes. A message bigger than budget gets a list of its own,
+    messages of unknown size count as 0 bytes'''
+    chunk = []
+    chunk_bytes = 0
+    for msgid in msgids:
+        msgid_bytes = sizes.get(msgid, 0)
+        if chunk and (len(chunk) >= size or
+                      budget and chunk_bytes + msgid_bytes > budget):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(msgid)
+        chunk_bytes += msgid_bytes
+    if chunk:
+        yield chunk
+
+
+def message_set(msgids):
+    '''Return an IMAP message set for msgids, collapsing consecutive ids into
+    ranges, ie ['1', '2', '3', '5'] becomes '1:3,5' '''
+    ranges = []
+    for msgid in sorted(set(int(msgid) for msgid in msgids)):
+        if ranges and ranges[-1][1] == msgid - 1:
+            ranges[-1][1] = msgid
+        else:
+            ranges.append([msgid, msgid])
+    return ','.join(
+        '%d' % start if start == stop else '%d:%d' % (start, stop)
+        for start, stop in ranges)
+
+
+def parse_fetch_response(data):
+    '''Yield (message number, uid, literal) for every message in the data
+    imaplib returns for a FETCH command. uid is None if the server didn't
+    send one'''
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+        header, literal = item
+        match = FETCH_HEADER.match(header)
+        if not match:
+            continue
+        uid = FETCH_UID.search(header)
+        if not uid and index + 1 < len(data) and\
+                isinstance(data[index + 1], basestring):
+            # some servers send the UID after the literal
+            uid = FETCH_UID.search(data[index + 1])
+        yield match.group('seq'), uid and uid.group('uid'), literal
+
+
+def parse_fetch_sizes(data):
+    '''Return {uid: RFC822.SIZE} for the messages in the data imaplib
+    returns for a FETCH command of RFC822.SIZE and a literal, ie a header'''
+    result = {}
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+        text = item[0]
+        if index + 1 < len(data) and isinstance(data[index + 1], basestring):
+            # items after the literal come as the next element
+            text += ' ' + data[index + 1]
+        uid = FETCH_UID.search(text)
+        size = FETCH_SIZE.search(text)
+        if uid and size:
+            result[uid.group('uid')] = int(size.group('size'))
+    return result
+
+
+def _parse_sexp(text, literals):
+    '''Parse IMAP data as nested lists of strings. NIL becomes None, literals
+    ({n} in text) are taken from literals in order'''
+    stack = [[]]
+    position = 0
+    while position < len(text):
+        match = SEXP_TOKEN.match(text, position)
+        if not match or match.end() == position:
+            if text[position:].strip():
+                raise ValueError('Cannot parse %r' % text[position:])
+            break
+        position = match.end()
+        if match.group('open'):
+            stack.append([])
+        elif match.group('close'):
+            if len(stack) < 2:
+                raise ValueError('Unbalanced parentheses in %r' % text)
+            value = stack.pop()
+            stack[-1].append(value)
+        elif match.group('quoted') is not None:
+            stack[-1].append(re.sub(r'\\(.)', r'\1', match.group('quoted')))
+        elif match.group('literal'):
+            stack[-1].append(literals.pop(0))
+        elif match.group('atom') is not None:
+            atom = match.group('atom')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    if len(stack) != 1:
+        raise ValueError('Unbalanced parentheses in %r' % text)
+    return stack[0]
+
+
+def parse_fetch_items(data):
+    '''Yield (message number, dict) for every message in the data imaplib
+    returns for a FETCH command. The dict maps the uppercased data item names
+    to their parsed values, ie ENVELOPE to a list of ten elements'''
+    text = ''
+    literals = []
+    for item in data:
+        if isinstance(item, tuple):
+            text += item[0]
+            literals.append(item[1])
+        elif item:
+            text += item
+    values = _parse_sexp(text, literals)
+    for seq, items in zip(values[::2], values[1::2]):
+        yield seq, dict(
+            (name.upper(), value)
+            for name, value in zip(items[::2], items[1::2]))
+
+
+class flag_buffer(object):
+    '''Collects flags to set on messages during a folder run, to store them
+    with as few commands as possible afterwards'''
+
+    store_batch_size = 1000
+    '''Messages to store a flag on with one command'''
+
+    def __init__(self):
+        self.flags = {}
+
+    def add(self, msgid, flag):
+        self.flags.setdefault(flag, set()).add(msgid)
+
+    def discard(self, msgids):
+        '''Forget about flags for msgids, ie because handling them was
+        rolled back'''
+        for msgid_set in self.flags.itervalues():
+            msgid_set.difference_update(msgids)
+
+    def flush(self, connection):
+        '''Store all collected flags, return the flags stored'''
+        stored = []
+        for flag, msgids in self.flags.iteritems():
+            if not msgids:
+                continue
+            for chunk in chunked(sorted(msgids, key=int),
+                                 self.store_batch_size):
+                connection.uid(
+                    'STORE', message_set(chunk), '+FLAGS.SILENT', flag)
+            stored.append(flag)
+        self.flags = {}
+        return stored
+
+
+def _has_buffered_data(connection):
+    '''Return if imaplib read data from the socket we didn't consume yet'''
+    rbuf = getattr(getattr(connection, 'file', None), '_rbuf', None)
+    if rbuf is not None and rbuf.tell():
+        return True
+    sslobj = getattr(connection, 'sslobj', None)
+    return bool(sslobj is not None and sslobj.pending())
+
+
+def idle(connection, timeout):
+    '''Send IDLE (RFC 2177) on a connection with a selected mailbox and wait
+    at most timeout seconds for the server to report new messages.
+    Return True if it did'''
+    tag = connection._new_tag()
+    connection.send('%s IDLE\r\n' % tag)
+    response = connection.readline()
+    if not response.startswith('+'):
+        raise connection.error('IDLE not accepted: %s' % response.strip())
+    exists = False
+    deadline = time.time() + timeout
+    while not exists:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        if not _has_buffered_data(connection) and not select.select(
+                [connection.socket()], [], [], remaining)[0]:
+            break
+        response = connection.readline()
+        if not response:
+            raise connection.abort('connection closed during IDLE')
+        exists = bool(IDLE_EXISTS.match(response))
+    connection.send('DONE\r\n')
+    while True:
+        response = connection.readline()
+        if not response:
+            raise connection.abort('connection closed during IDLE')
+        if response.startswith(tag):
+            if response.split()[1] != 'OK':
+                raise connection.error(
+                    'IDLE failed: %s' % response.strip())
+            return exists
+        exists = exists or bool(IDLE_EXISTS.match(response))
@@ -24,3 +24,4 @@ from . import base
 from . import email_exact
 from . import email_domain
 from . import openerp_standard
+from . import token_score
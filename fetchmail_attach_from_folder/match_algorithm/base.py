@@ -19,9 +19,52 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+from openerp.tools.safe_eval import safe_eval
+
+algorithms = {}
+'''All match algorithms by class name, filled when their classes are
+defined'''
+
+
+class algorithm_registry(type):
+    '''Registers every subclass of base in algorithms'''
+
+    version = 0
+    '''Incremented whenever an algorithm is added'''
+
+    def __init__(cls, name, bases, attrs):
+        super(algorithm_registry, cls).__init__(name, bases, attrs)
+        if any(isinstance(b, algorithm_registry) for b in bases):
+            algorithms[name] = cls
+            algorithm_registry.version += 1
+
+
+def read_values(cr, uid, conf, model_fields):
+    '''Return [(id, values)] for the records matching conf's domain, in the
+    order of conf's model_order, values being the values of model_fields.
+    Only the columns of model_fields are read, relational fields are
+    returned as read() returns them. Dotted paths are followed with
+    mapped'''
+    conf_model = conf.env[conf.model_id.model].sudo(uid)
+    plain_fields = [field for field in model_fields if '.' not in field]
+    dotted_fields = [field for field in model_fields if '.' in field]
+    rows = conf_model.search_read(
+        safe_eval(conf.domain or '[]'), plain_fields or ['id'],
+        order=conf.model_order)
+    result = []
+    for row in rows:
+        values = [row[field] for field in plain_fields]
+        if dotted_fields:
+            record = conf_model.browse(row['id'])
+            for field in dotted_fields:
+                values.extend(record.mapped(field))
+        result.append((row['id'], values))
+    return result
 
 
 class base(object):
+    __metaclass__ = algorithm_registry
+
     name = None
     '''Name shown to the user'''
 
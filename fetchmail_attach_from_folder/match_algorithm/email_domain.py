@@ -35,11 +35,6 @@ class email_domain(email_exact):
             domains = []
             for addr in self._get_mailaddresses(conf, mail_message):
                 domains.append(addr.split('@')[-1])
-            ids = conf.pool.get(conf.model_id.model).search(
-                cr, uid,
-                self._get_mailaddress_search_domain(
-                    conf, mail_message,
-                    operator='like',
-                    values=['%@' + domain for domain in set(domains)]),
-                order=conf.model_order)
+            ids = self._get_address_index(cr, uid, conf).search_domains(
+                set(domains))
         return ids
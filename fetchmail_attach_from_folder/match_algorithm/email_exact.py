@@ -20,17 +20,61 @@
 #
 ##############################################################################
 
-from .base import base
+from .base import base, read_values
 from openerp.tools.safe_eval import safe_eval
 from openerp.tools.mail import email_split
 
 
+class address_index(object):
+    '''Maps lowercased addresses and their domains to the ids of the records
+    having them, in the order of the folder's model_order'''
+
+    def __init__(self, cr, uid, conf):
+        self.ranks = {}
+        self.by_address = {}
+        self.by_domain = {}
+        for rank, (record_id, values) in enumerate(
+                read_values(cr, uid, conf, [conf.model_field])):
+            self.ranks[record_id] = rank
+            for value in values:
+                if not value or not isinstance(value, basestring):
+                    continue
+                address = value.lower()
+                self.by_address.setdefault(address, []).append(record_id)
+                if '@' in address:
+                    self.by_domain.setdefault(
+                        address.rsplit('@', 1)[1], []).append(record_id)
+
+    def _lookup(self, index, keys):
+        ids = set()
+        for key in keys:
+            ids.update(index.get(key, []))
+        return sorted(ids, key=self.ranks.get)
+
+    def search_addresses(self, addresses):
+        '''Return ids of records having one of addresses'''
+        return self._lookup(self.by_address, addresses)
+
+    def search_domains(self, domains):
+        '''Return ids of records having an address in one of domains'''
+        return self._lookup(self.by_domain, domains)
+
+
 class email_exact(base):
     '''Search for exactly the mailadress as noted in the email'''
 
     name = 'Exact mailadress'
     required_fields = ['model_field', 'mail_field']
 
+    _address_index = None
+
+    def _get_address_index(self, cr, uid, conf):
+        '''Return an address_index for conf, built once per algorithm
+        instance, which is once per folder per run'''
+        if self._address_index is None:
+            self._address_index = address_index(cr, uid, conf)
+        return self._address_index
+
     def _get_mailaddresses(self, conf, mail_message):
         mailaddresses = []
         fields = conf.mail_field.split(',')
@@ -51,7 +95,5 @@ class email_exact(base):
         return search_domain
 
     def search_matches(self, cr, uid, conf, mail_message, mail_message_org):
-        conf_model = conf.pool.get(conf.model_id.model)
-        search_domain = self._get_mailaddress_search_domain(conf, mail_message)
-        return conf_model.search(
-            cr, uid, search_domain, order=conf.model_order)
+        return self._get_address_index(cr, uid, conf).search_addresses(
+            self._get_mailaddresses(conf, mail_message))
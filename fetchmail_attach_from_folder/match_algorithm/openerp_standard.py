@@ -53,6 +53,6 @@ class openerp_standard(base):
         )
 
         if folder.delete_matching:
-            connection.store(msgid, '+FLAGS', '\\DELETED')
+            folder.server_id.flag_message(connection, msgid, '\\DELETED')
 
         return [result]
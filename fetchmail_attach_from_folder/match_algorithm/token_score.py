@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import email
+import math
+import re
+from .base import base, read_values
+from openerp.tools import ustr
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+HTML_TAG = re.compile(r'<[^>]*>')
+
+
+def tokenize(text, min_length=3):
+    '''Return the set of lowercased words in text. Words shorter than
+    min_length are ignored unless they contain a digit'''
+    return set(
+        token for token in TOKEN.findall(ustr(text).lower())
+        if len(token) >= min_length or any(c.isdigit() for c in token))
+
+
+class token_index(object):
+    '''Maps the tokens of the values of a folder's model fields to the ids of
+    the records having them, and knows how rare every token is. Keeps the
+    tokens of every value to compute how much of it an email contains'''
+
+    def __init__(self, cr, uid, conf, min_length=3):
+        model_fields = [
+            field.strip() for field in conf.model_field.split(',')
+            if field.strip()]
+        records = read_values(cr, uid, conf, model_fields)
+        self.min_length = min_length
+        self.ranks = {}
+        self.by_token = {}
+        self.values = {}
+        for rank, (record_id, record_values) in enumerate(records):
+            self.ranks[record_id] = rank
+            tokens = set()
+            values = []
+            for value in record_values:
+                if isinstance(value, bool) or\
+                        not isinstance(value, (basestring, int, long)):
+                    continue
+                value_tokens = tokenize(value, min_length)
+                if value_tokens:
+                    values.append(frozenset(value_tokens))
+                tokens.update(value_tokens)
+            self.values[record_id] = values
+            for token in tokens:
+                self.by_token.setdefault(token, []).append(record_id)
+        self.weights = dict(
+            (token, math.log(float(len(records) + 1) / len(ids)))
+            for token, ids in self.by_token.iteritems())
+
+    def coverage(self, record_id, tokens):
+        '''Return the biggest share of the weight of one of the record's
+        values that tokens contain, between 0 and 1'''
+        result = 0.0
+        for value_tokens in self.values[record_id]:
+            total = sum(self.weights[token] for token in value_tokens)
+            if total:
+                result = max(result, sum(
+                    self.weights[token] for token in value_tokens & tokens
+                ) / total)
+        return result
+
+    def search(self, tokens, max_candidates=None, min_coverage=0):
+        '''Return [(score, id)] for records sharing tokens, best first.
+        Tokens shared by more than max_candidates records are ignored.
+        Records none of whose values are covered by tokens for at least
+        min_coverage are left out, see coverage'''
+        tokens = set(tokens)
+        scores = {}
+        for token in tokens:
+            ids = self.by_token.get(token)
+            if not ids or max_candidates and len(ids) > max_candidates:
+                continue
+            weight = self.weights[token]
+            for record_id in ids:
+                scores[record_id] = scores.get(record_id, 0.0) + weight
+        if min_coverage:
+            scores = dict(
+                (record_id, score)
+                for record_id, score in scores.iteritems()
+                if self.coverage(record_id, tokens) >= min_coverage)
+        return sorted(
+            ((score, record_id) for record_id, score in scores.iteritems()),
+            key=lambda result: (-result[0], self.ranks[result[1]]))
+
+
+class token_score(base):
+    '''Search for records sharing the most words with the email. Put a comma
+    separated list of fields to index in 'Field (model)', ie 'name,ref' and
+    the parts of the email to search in 'Field (email)', ie 'subject,body'.
+    Other names in 'Field (email)' are read as headers of the original
+    email. Rare words weigh more than common ones, the best scoring
+    records match. A record only matches if the email contains at least
+    min_coverage of the weight of one of its values, so a mail sharing a
+    single word like 'the' with 'The Jackson Group' doesn't match it'''
+
+    name = 'Best scoring words'
+    required_fields = ['model_field', 'mail_field']
+
+    min_length = 3
+    '''Minimal length of words to consider, words with digits always count'''
+
+    max_candidates = 1000
+    '''Ignore words shared by more records than this'''
+
+    min_coverage = 0.5
+    '''Default share of the weight of a value an email must contain to match,
+    set the system parameter
+    fetchmail_attach_from_folder.token_score_min_coverage to change it'''
+
+    _token_index = None
+    _min_coverage = None
+
+    def _get_token_index(self, cr, uid, conf):
+        '''Return a token_index for conf, built once per algorithm
+        instance, which is once per folder per run'''
+        if self._token_index is None:
+            self._token_index = token_index(
+                cr, uid, conf, min_length=self.min_length)
+        return self._token_index
+
+    def _get_min_coverage(self, conf):
+        if self._min_coverage is None:
+            self._min_coverage = float(
+                conf.env['ir.config_parameter'].sudo().get_param(
+                    'fetchmail_attach_from_folder.token_score_min_coverage',
+                    self.min_coverage))
+        return self._min_coverage
+
+    def _get_tokens(self, conf, mail_message, mail_message_org):
+        tokens = set()
+        headers = None
+        for field in conf.mail_field.split(','):
+            field = field.strip()
+            if not field:
+                continue
+            if mail_message and field in mail_message:
+                value = mail_message[field] or ''
+                if field == 'body':
+                    value = HTML_TAG.sub(' ', value)
+            else:
+                if headers is None:
+                    headers = email.message_from_string(
+                        mail_message_org or '')
+                value = ' '.join(headers.get_all(field) or [])
+            if isinstance(value, basestring):
+                tokens.update(tokenize(value, self.min_length))
+        return tokens
+
+    def search_matches(self, cr, uid, conf, mail_message, mail_message_org):
+        results = self._get_token_index(cr, uid, conf).search(
+            self._get_tokens(conf, mail_message, mail_message_org),
+            max_candidates=self.max_candidates,
+            min_coverage=self._get_min_coverage(conf))
+        return [
+            record_id for score, record_id in results
+            if score >= results[0][0]
+        ]
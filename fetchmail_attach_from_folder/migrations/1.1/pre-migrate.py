@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+def migrate(cr, version):
+    '''Folders existing before incremental sync keep checking all messages,
+    they may rely on non-matching mail being attached once its record
+    exists. Creating the column here keeps the default from being applied
+    to them'''
+    if not version:
+        return
+    cr.execute(
+        "select 1 from information_schema.columns where "
+        "table_name='fetchmail_server_folder' and "
+        "column_name='incremental_sync'")
+    if cr.fetchone():
+        return
+    cr.execute(
+        'alter table fetchmail_server_folder '
+        'add column incremental_sync boolean')
+    cr.execute('update fetchmail_server_folder set incremental_sync=False')
@@ -21,13 +21,50 @@
 ##############################################################################
 import logging
 import base64
+import email
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import Queue
+from contextlib import closing
+import psycopg2
 import simplejson
 from lxml import etree
-from openerp import models, fields, api, exceptions
+from openerp import models, fields, api, exceptions, registry, sql_db
 from openerp.tools.translate import _
 from openerp.tools.misc import UnquoteEvalContext
+from openerp.tools.lru import LRU
+from .. import imap_idle
+from .. import match_algorithm
+from ..imap_pool import pool
+from ..imap_utils import chunked, chunked_by_size, flag_buffer,\
+    message_set, parse_fetch_response, parse_fetch_sizes
+from ..run_stats import run_stats
 _logger = logging.getLogger(__name__)
 
+HEADER_FIELDS = ('MESSAGE-ID', 'FROM', 'TO')
+'''Headers fetched to check if we know a message already'''
+
+MESSAGE_ID_LOCK = 0x66746368
+'''First key of the advisory locks taken on Message-IDs being stored'''
+
+SHARD_TIMEOUT = 3600
+'''Default seconds shard processes may take before they are terminated, set
+the system parameter fetchmail_attach_from_folder.shard_timeout to change
+it'''
+
+SHARD_KILL_DELAY = 5
+'''Seconds to wait for a terminated shard before killing it'''
+
+HEADER_BATCH_SIZE = 500
+'''Amount of messages to fetch headers for in one IMAP command'''
+
+_folder_form_cache = LRU(64)
+'''Folder form archs with modifiers for match algorithms, by (original arch,
+language, algorithm registry version)'''
+
 
 class fetchmail_server(models.Model):
     _inherit = 'fetchmail.server'
@@ -55,6 +92,12 @@ class fetchmail_server(models.Model):
             context = {}
 
         check_original = []
+        jobs = []
+        icp = self.pool['ir.config_parameter']
+        workers = int(icp.get_param(
+            cr, uid, 'fetchmail_attach_from_folder.workers', '1'))
+        worker_unit = icp.get_param(
+            cr, uid, 'fetchmail_attach_from_folder.worker_unit', 'server')
 
         for this in self.browse(cr, uid, ids, context):
             if this.object_id:
@@ -66,14 +109,77 @@ class fetchmail_server(models.Model):
                     'server_type': this.type
                 })
 
-            connection = this.connect()
-            for folder in this.folder_ids:
-                this.handle_folder(connection, folder)
-            connection.close()
+            if workers <= 1:
+                this.handle_folders(this.folder_ids)
+            elif worker_unit == 'folder':
+                jobs += [(this.id, [folder.id]) for folder in this.folder_ids]
+            else:
+                jobs.append((this.id, this.folder_ids.ids))
+
+        if jobs:
+            self._fetch_mail_parallel(cr, uid, jobs, workers, context=context)
 
         return super(fetchmail_server, self).fetch_mail(
             cr, uid, check_original, context)
 
+    def _fetch_mail_parallel(self, cr, uid, jobs, workers, context=None):
+        '''Run jobs, a list of (server id, [folder id]), in at most workers
+        threads. Every job uses its own IMAP connection and cursor, and
+        commits when done'''
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        threads = [
+            threading.Thread(
+                target=self._fetch_mail_worker,
+                args=(cr.dbname, uid, queue, dict(context or {})),
+                name='fetchmail_worker_%d' % i)
+            for i in range(min(workers, len(jobs)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _fetch_mail_worker(self, dbname, uid, queue, context):
+        while True:
+            try:
+                server_id, folder_ids = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                with api.Environment.manage():
+                    with registry(dbname).cursor() as cr:
+                        env = api.Environment(cr, uid, dict(
+                            context, fetchmail_server_id=server_id))
+                        server = env['fetchmail.server'].browse(server_id)
+                        server = server.with_context(
+                            server_type=server.type)
+                        server.handle_folders(
+                            env['fetchmail.server.folder'].browse(folder_ids))
+            except Exception:
+                _logger.exception(
+                    'Failed to fetch folders %s of server %s',
+                    folder_ids, server_id)
+            _logger.info(
+                '%s handled folders %s of server %s in %.3fs',
+                threading.current_thread().name, folder_ids, server_id,
+                time.time() - start)
+
+    @api.multi
+    def handle_folders(self, folders):
+        '''Handle folders on a pooled connection and make sure folders in
+        push mode have a listener'''
+        for this in self:
+            with pool.connection(this) as connection:
+                for folder in folders:
+                    this.handle_folder(connection, folder)
+            for folder in folders:
+                if folder.idle:
+                    imap_idle.ensure_listener(
+                        self.env.cr.dbname, self.env.uid, folder.id)
+
     @api.multi
     def handle_folder(self, connection, folder):
         '''Return ids of objects matched'''
@@ -84,81 +190,591 @@ class fetchmail_server(models.Model):
             _logger.info(
                 'start checking for emails in %s server %s',
                 folder.path, this.name)
+            stats = run_stats()
 
             match_algorithm = folder.get_algorithm()
 
+            # don't handle a folder that is handled somewhere else right now,
+            # or was after our transaction started
+            try:
+                self.env.cr.execute('savepoint handle_folder')
+                self.env.cr.execute(
+                    'select id from fetchmail_server_folder where id=%s '
+                    'for update nowait', (folder.id,), log_exceptions=False)
+                self.env.cr.execute('release savepoint handle_folder')
+            except psycopg2.OperationalError:
+                self.env.cr.execute('rollback to savepoint handle_folder')
+                _logger.info(
+                    'Skipping %s on %s, it is being checked already',
+                    folder.path, this.server)
+                continue
+
+            # collect flags to store them all at once in the end
+            flags = flag_buffer()
+            # messages to try again in the next run
+            failed = set()
+            this = this.with_context(
+                fetchmail_flag_buffer=flags, fetchmail_run_stats=stats,
+                fetchmail_failed_msgids=failed)
+            folder = folder.with_context(
+                fetchmail_flag_buffer=flags, fetchmail_run_stats=stats,
+                fetchmail_failed_msgids=failed)
+
             if connection.select(folder.path)[0] != 'OK':
                 _logger.error(
                     'Could not open mailbox %s on %s',
                     folder.path, this.server)
                 connection.select()
                 continue
-            result, msgids = this.get_msgids(connection)
+            uidvalidity = connection.response('UIDVALIDITY')[1][0]
+            last_uid = 0
+            if folder.incremental_sync and uidvalidity and\
+                    folder.uidvalidity == uidvalidity:
+                last_uid = int(folder.last_uid or 0)
+            elif folder.uidvalidity and folder.uidvalidity != uidvalidity:
+                _logger.info(
+                    'UIDVALIDITY of %s on %s changed, rescanning folder',
+                    folder.path, this.server)
+            with stats.timer('search'):
+                result, msgids = this.get_msgids(
+                    connection, last_uid=last_uid)
             if result != 'OK':
                 _logger.error(
                     'Could not search mailbox %s on %s',
                     folder.path, this.server)
                 continue
 
-            for msgid in msgids[0].split():
-                matched_object_ids += this.apply_matching(
-                    connection, folder, msgid, match_algorithm)
+            # UID searches for n:* always return the highest UID
+            msgids = [
+                msgid for msgid in msgids[0].split() if int(msgid) > last_uid
+            ]
+            stats.count('seen', len(msgids))
+            sizes = {}
+            unknown_msgids = this.filter_known_msgids(
+                connection, folder, msgids, sizes=sizes)
+            stats.count('duplicate', len(msgids) - len(unknown_msgids))
+            expunge = False
+            if folder.shards > 1 and\
+                    len(unknown_msgids) > max(folder.fetch_batch_size, 1):
+                shard_object_ids, expunge = this.handle_shards(
+                    folder, unknown_msgids, sizes=sizes)
+                matched_object_ids += shard_object_ids
+            else:
+                matched_object_ids += this.handle_msgids(
+                    connection, folder, unknown_msgids, match_algorithm,
+                    sizes=sizes)
+
+            with stats.timer('flags'):
+                if '\\DELETED' in flags.flush(connection) or expunge:
+                    connection.expunge()
+
+            values = folder._run_stats_values(stats)
+            if msgids or folder.uidvalidity != uidvalidity:
+                # stay below the first message that failed, so that it's
+                # searched again in the next run
+                next_last_uid = max(
+                    [last_uid] + [int(msgid) for msgid in msgids])
+                if failed:
+                    next_last_uid = min(
+                        [next_last_uid] +
+                        [int(msgid) - 1 for msgid in failed])
+                values.update({
+                    'uidvalidity': uidvalidity,
+                    'last_uid': str(next_last_uid),
+                })
+            folder.write(values)
 
+            duration = stats.duration()
             _logger.info(
-                'finished checking for emails in %s server %s',
-                folder.path, this.name)
+                'finished checking for emails in %s server %s: '
+                '%d messages in %.2fs (%.1f messages/s), %s',
+                folder.path, this.name, len(msgids), duration,
+                len(msgids) / duration if duration else 0,
+                ', '.join(
+                    '%s %.2fs' % (stage, stats.timers[stage])
+                    for stage in sorted(stats.timers)))
 
         return matched_object_ids
 
     @api.multi
-    def get_msgids(self, connection):
-        '''Return imap ids of messages to process'''
-        return connection.search(None, 'UNDELETED')
+    def handle_msgids(self, connection, folder, msgids, match_algorithm,
+                      sizes=None):
+        '''Download, match and store the messages msgids of the selected
+        folder. Return ids of objects matched. sizes are the messages' sizes
+        by msgid as far as known'''
+        self.ensure_one()
+        matched_object_ids = []
+        pending = [] if folder.match_batch_size > 1 else None
+        if folder.fetch_batch_size > 1:
+            msgdata = self.fetch_msgdata(
+                connection, folder, msgids, sizes=sizes)
+        else:
+            msgdata = ((msgid, None) for msgid in msgids)
+        for msgid, mail_message_org in msgdata:
+            if mail_message_org is None:
+                matched_object_ids += self.apply_matching(
+                    connection, folder, msgid, match_algorithm,
+                    pending=pending)
+            else:
+                matched_object_ids += self.apply_matching_message(
+                    connection, folder, msgid, mail_message_org,
+                    match_algorithm, pending=pending)
+            if pending and len(pending) >= folder.match_batch_size:
+                matched_object_ids += self.apply_matches(
+                    connection, folder, match_algorithm, pending)
+                pending = []
+        if pending:
+            matched_object_ids += self.apply_matches(
+                connection, folder, match_algorithm, pending)
+        return matched_object_ids
 
     @api.multi
-    def apply_matching(self, connection, folder, msgid, match_algorithm):
+    def handle_shards(self, folder, msgids, sizes=None):
+        '''Split msgids in folder.shards consecutive ranges and handle them
+        in as many processes, each with its own IMAP connection and
+        transaction. Return ids of objects matched and if messages were
+        flagged as deleted.
+        Shards never see the same Message-ID, because filter_known_msgids
+        only returns the first message for every Message-ID'''
+        self.ensure_one()
+        chunks = self._split_shards(folder, msgids)
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=self._handle_shard,
+                args=(self.env.cr.dbname, self.env.uid, self.id, folder.id,
+                      index, chunk, queue, dict(
+                          (msgid, sizes[msgid]) for msgid in chunk
+                          if msgid in (sizes or {}))),
+                name='fetchmail_shard_%d_%d' % (folder.id, index))
+            for index, chunk in enumerate(chunks)
+        ]
+        _logger.info(
+            'Handling %d messages in %s on %s in %d processes',
+            len(msgids), folder.path, self.server, len(processes))
+        timeout = float(self.env['ir.config_parameter'].get_param(
+            'fetchmail_attach_from_folder.shard_timeout', SHARD_TIMEOUT))
+        deadline = time.time() + timeout
+        for process in processes:
+            process.start()
+        results = {}
+        while len(results) < len(processes) and time.time() < deadline:
+            try:
+                index, result = queue.get(
+                    timeout=max(min(1, deadline - time.time()), 0.01))
+            except Queue.Empty:
+                if any(process.is_alive() for process in processes):
+                    continue
+                try:
+                    index, result = queue.get(timeout=1)
+                except Queue.Empty:
+                    # some process died without reporting
+                    break
+            results[index] = result
+        for index, process in enumerate(processes):
+            process.join(max(deadline - time.time(), 0))
+            if not process.is_alive():
+                continue
+            _logger.error(
+                'Shard %d of %s on %s did not finish within %ds, '
+                'terminating it', index, folder.path, self.server, timeout)
+            results.pop(index, None)
+            process.terminate()
+            process.join(SHARD_KILL_DELAY)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        return self._merge_shards(chunks, results)
+
+    @api.model
+    def _split_shards(self, folder, msgids):
+        '''Return msgids split in at most folder.shards lists'''
+        size = -(-len(msgids) // max(folder.shards, 1))
+        return list(chunked(msgids, max(size, 1)))
+
+    @api.model
+    def _merge_shards(self, chunks, results):
+        '''Merge the results of shards, a dict of chunk index and the
+        result of _run_shard or None, into the current folder run. Return ids
+        of objects matched and if messages were flagged as deleted. Messages
+        of shards that failed or never reported are marked as failed'''
+        stats = self._run_stats()
+        matched_object_ids = []
+        expunge = False
+        for index, chunk in enumerate(chunks):
+            result = results.get(index)
+            if result is None:
+                stats.count('failed', len(chunk))
+                self._mark_failed(chunk)
+                continue
+            matched_object_ids += result['matched_object_ids']
+            expunge = expunge or result['expunge']
+            stats.merge(result['stats'])
+            self._mark_failed(result['failed_msgids'])
+        return matched_object_ids, expunge
+
+    def _handle_shard(self, dbname, uid, server_id, folder_id, index, msgids,
+                      queue, sizes):
+        '''Handle msgids in a forked process, put (index, result) in
+        queue'''
+        # the server's signal handlers would ignore terminate()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # database connections inherited from the parent belong to the
+        # parent, so use a pool of our own and leave the inherited one alone
+        db_pool = sql_db.ConnectionPool(1)
+        result = None
+        try:
+            with api.Environment.manage():
+                with closing(sql_db.Connection(
+                        db_pool, *sql_db.dsn(dbname)).cursor()) as cr:
+                    env = api.Environment(cr, uid, {})
+                    result = env['fetchmail.server'].browse(server_id)\
+                        ._run_shard(
+                            env['fetchmail.server.folder'].browse(folder_id),
+                            msgids, commit=True, sizes=sizes)
+        except Exception:
+            _logger.exception(
+                'Failed to handle shard of %d messages in folder %d',
+                len(msgids), folder_id)
+        finally:
+            db_pool.close_all()
+        queue.put((index, result))
+
+    @api.multi
+    def _run_shard(self, folder, msgids, commit=False, sizes=None):
+        '''Handle msgids of folder on a new IMAP connection and return the
+        result to merge with _merge_shards. If commit is set, commit before
+        storing flags on the server'''
+        self.ensure_one()
+        stats = run_stats()
+        flags = flag_buffer()
+        failed = set()
+        this = self.with_context(
+            fetchmail_server_id=self.id, fetchmail_flag_buffer=flags,
+            fetchmail_run_stats=stats, fetchmail_failed_msgids=failed)
+        folder = folder.with_context(this.env.context)
+        connection = this.connect()
+        try:
+            if connection.select(folder.path)[0] != 'OK':
+                raise Exception('Could not open mailbox %s' % folder.path)
+            matched_object_ids = this.handle_msgids(
+                connection, folder, msgids, folder.get_algorithm(),
+                sizes=sizes)
+            if commit:
+                this.env.cr.commit()
+            with stats.timer('flags'):
+                expunge = '\\DELETED' in flags.flush(connection)
+        finally:
+            connection.logout()
+        return {
+            'matched_object_ids': matched_object_ids,
+            'expunge': expunge,
+            'stats': stats.as_dict(),
+            'failed_msgids': sorted(failed),
+        }
+
+    @api.multi
+    def get_msgids(self, connection, last_uid=0):
+        '''Return imap uids of messages to process. If last_uid is passed,
+        only search for messages that arrived after it'''
+        criteria = ['UNDELETED']
+        if last_uid:
+            criteria = ['UID', '%d:*' % (last_uid + 1)] + criteria
+        return connection.uid('SEARCH', *criteria)
+
+    @api.multi
+    def filter_known_msgids(self, connection, folder, msgids, sizes=None):
+        '''Return the msgids of messages whose Message-ID is not in the
+        database yet, downloading only the messages' headers. Of messages
+        with the same Message-ID, only the first is returned. If sizes is a
+        dict, the messages' sizes are added to it by msgid'''
+        self.ensure_one()
+        stats = self._run_stats()
+        unknown_msgids = []
+        seen_message_ids = set()
+        for chunk in chunked(msgids, HEADER_BATCH_SIZE):
+            with stats.timer('headers'):
+                result, msgdata = connection.uid(
+                    'FETCH', message_set(chunk),
+                    '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s)])' %
+                    ' '.join(HEADER_FIELDS))
+            if result != 'OK':
+                _logger.error(
+                    'Could not fetch headers of %s in %s on %s',
+                    message_set(chunk), folder.path, self.server)
+                unknown_msgids += chunk
+                continue
+            headers = dict(
+                (msgid, email.message_from_string(header_data))
+                for dummy, msgid, header_data in parse_fetch_response(
+                    msgdata))
+            if sizes is not None:
+                sizes.update(parse_fetch_sizes(msgdata))
+            message_ids = set(
+                header['message-id'] for header in headers.itervalues()
+                if header['message-id'])
+            known_message_ids = set()
+            if message_ids:
+                with stats.timer('dedup'):
+                    self.env.cr.execute(
+                        'select message_id from mail_message '
+                        'where message_id in %s', (tuple(message_ids),))
+                    known_message_ids = set(
+                        row[0] for row in self.env.cr.fetchall())
+            for msgid in chunk:
+                header = headers.get(msgid)
+                if header is not None and\
+                        header['message-id'] in known_message_ids:
+                    _logger.debug(
+                        'Skipping known message %s from %s to %s',
+                        header['message-id'], header['from'], header['to'])
+                    continue
+                if header is not None and header['message-id']:
+                    # only handle the first copy of a message
+                    if header['message-id'] in seen_message_ids:
+                        continue
+                    seen_message_ids.add(header['message-id'])
+                unknown_msgids.append(msgid)
+        return unknown_msgids
+
+    @api.multi
+    def fetch_msgdata(self, connection, folder, msgids, sizes=None):
+        '''Yield (msgid, raw message) for msgids, fetching
+        folder.fetch_batch_size messages of together at most
+        folder.fetch_batch_bytes, as far as sizes tells, per IMAP command'''
+        self.ensure_one()
+        stats = self._run_stats()
+        for chunk in chunked_by_size(
+                msgids, max(folder.fetch_batch_size, 1),
+                folder.fetch_batch_bytes, sizes or {}):
+            with stats.timer('fetch'):
+                result, msgdata = connection.uid(
+                    'FETCH', message_set(chunk), '(RFC822)')
+            if result != 'OK':
+                _logger.error(
+                    'Could not fetch %s in %s on %s',
+                    message_set(chunk), folder.path, self.server)
+                self._mark_failed(chunk)
+                continue
+            for dummy, msgid, mail_message_org in parse_fetch_response(
+                    msgdata):
+                yield msgid, mail_message_org
+
+    @api.multi
+    def apply_matching(self, connection, folder, msgid, match_algorithm,
+                       pending=None):
         '''Return ids of objects matched'''
 
         matched_object_ids = []
 
         for this in self:
-            result, msgdata = connection.fetch(msgid, '(RFC822)')
+            with this._run_stats().timer('fetch'):
+                result, msgdata = connection.uid('FETCH', msgid, '(RFC822)')
 
             if result != 'OK':
                 _logger.error(
                     'Could not fetch %s in %s on %s',
                     msgid, folder.path, this.server)
+                this._mark_failed([msgid])
                 continue
 
-            mail_message = self.env['mail.thread'].message_parse(
-                msgdata[0][1], save_original=this.original)
+            matched_object_ids += this.apply_matching_message(
+                connection, folder, msgid, msgdata[0][1], match_algorithm,
+                pending=pending)
 
-            if self.env['mail.message'].search(
-                    [('message_id', '=', mail_message['message_id'])]):
-                continue
+        return matched_object_ids
+
+    @api.multi
+    def apply_matching_message(self, connection, folder, msgid,
+                               mail_message_org, match_algorithm,
+                               pending=None):
+        '''Return ids of objects matched by an already fetched message.
+        If pending is a list, matches are appended to it as
+        (msgid, object id, mail_message, mail_message_org) to be handled
+        later by apply_matches instead'''
 
-            found_ids = match_algorithm.search_matches(
-                self.env.cr, self.env.uid, folder, mail_message, msgdata[0][1])
+        matched_object_ids = []
+
+        stats = self._run_stats()
+        for this in self:
+            with stats.timer('parse'):
+                mail_message = self.env['mail.thread'].message_parse(
+                    mail_message_org, save_original=this.original)
+
+            if pending is None:
+                with stats.timer('dedup'):
+                    known, busy = this._claim_message_ids(
+                        [mail_message['message_id']])
+                if known:
+                    stats.count('duplicate')
+                    continue
+                if busy:
+                    this._mark_failed([msgid])
+                    continue
+
+            with stats.timer('match'):
+                found_ids = match_algorithm.search_matches(
+                    self.env.cr, self.env.uid, folder, mail_message,
+                    mail_message_org)
 
             if found_ids and (len(found_ids) == 1 or
                               folder.match_first):
-                try:
-                    self.env.cr.execute('savepoint apply_matching')
-                    match_algorithm.handle_match(
-                        self.env.cr, self.env.uid, connection,
-                        found_ids[0], folder, mail_message,
-                        msgdata[0][1], msgid, self.env.context)
-                    self.env.cr.execute('release savepoint apply_matching')
-                    matched_object_ids += found_ids[:1]
-                except Exception:
-                    self.env.cr.execute('rollback to savepoint apply_matching')
-                    _logger.exception(
-                        "Failed to fetch mail %s from %s", msgid, this.name)
+                if pending is not None:
+                    pending.append(
+                        (msgid, found_ids[0], mail_message, mail_message_org))
+                    continue
+                matched_object_ids += this.apply_match(
+                    connection, folder, match_algorithm, msgid, found_ids[0],
+                    mail_message, mail_message_org)
             elif folder.flag_nonmatching:
-                connection.store(msgid, '+FLAGS', '\\FLAGGED')
+                this.flag_message(connection, msgid, '\\FLAGGED')
+                stats.count('flagged')
+
+        return matched_object_ids
 
+    @api.multi
+    def apply_match(self, connection, folder, match_algorithm, msgid,
+                    object_id, mail_message, mail_message_org):
+        '''Handle a match in its own savepoint, return [object_id] if that
+        worked'''
+        self.ensure_one()
+        stats = self._run_stats()
+        try:
+            with stats.timer('handle'):
+                self.env.cr.execute('savepoint apply_matching')
+                match_algorithm.handle_match(
+                    self.env.cr, self.env.uid, connection,
+                    object_id, folder, mail_message,
+                    mail_message_org, msgid, self.env.context)
+                self.env.cr.execute('release savepoint apply_matching')
+            stats.count('matched')
+            return [object_id]
+        except Exception:
+            self.env.cr.execute('rollback to savepoint apply_matching')
+            self._discard_flags([msgid])
+            self._mark_failed([msgid])
+            stats.count('failed')
+            _logger.exception(
+                "Failed to fetch mail %s from %s", msgid, self.name)
+        return []
+
+    @api.multi
+    def apply_matches(self, connection, folder, match_algorithm, matches):
+        '''Handle a list of matches as collected by apply_matching_message
+        in a single savepoint. If that fails, fall back to handling them one
+        by one. Return ids of objects matched'''
+        self.ensure_one()
+        stats = self._run_stats()
+        with stats.timer('dedup'):
+            known_message_ids, busy_message_ids = self._claim_message_ids(
+                [match[2]['message_id'] for match in matches])
+        todo = []
+        for match in matches:
+            if match[2]['message_id'] in known_message_ids:
+                stats.count('duplicate')
+                continue
+            if match[2]['message_id'] in busy_message_ids:
+                self._mark_failed([match[0]])
+                continue
+            known_message_ids.add(match[2]['message_id'])
+            todo.append(match)
+        if not todo:
+            return []
+        try:
+            with stats.timer('handle'):
+                self.env.cr.execute('savepoint apply_matches')
+                for msgid, object_id, mail_message, mail_message_org in todo:
+                    match_algorithm.handle_match(
+                        self.env.cr, self.env.uid, connection,
+                        object_id, folder, mail_message,
+                        mail_message_org, msgid, self.env.context)
+                self.env.cr.execute('release savepoint apply_matches')
+            stats.count('matched', len(todo))
+            return [match[1] for match in todo]
+        except Exception:
+            self.env.cr.execute('rollback to savepoint apply_matches')
+            self._discard_flags([match[0] for match in todo])
+            _logger.warning(
+                'Failed to handle a batch of %d mails from %s, retrying '
+                'them one by one', len(todo), self.name)
+        matched_object_ids = []
+        for match in todo:
+            matched_object_ids += self.apply_match(
+                connection, folder, match_algorithm, *match)
         return matched_object_ids
 
+    @api.model
+    def _claim_message_ids(self, message_ids):
+        '''Lock Message-IDs for the current transaction, so that concurrent
+        runs on other folders, servers or workers don't store the same mail
+        twice. Return the Message-IDs stored already, by this transaction or
+        a committed one, and those another transaction is storing right
+        now. The latter should be retried later'''
+        message_ids = tuple(set(
+            message_id for message_id in message_ids if message_id))
+        known = set()
+        busy = set()
+        if not message_ids:
+            return known, busy
+        cr = self.env.cr
+        cr.execute(
+            'select message_id from mail_message where message_id in %s',
+            (message_ids,))
+        known.update(row[0] for row in cr.fetchall())
+        todo = [
+            message_id for message_id in message_ids
+            if message_id not in known]
+        if not todo:
+            return known, busy
+        cr.execute(
+            'select message_id, pg_try_advisory_xact_lock(%s, '
+            'hashtext(message_id)) from unnest(%s::varchar[]) message_id',
+            (MESSAGE_ID_LOCK, sorted(todo)))
+        locked = []
+        for message_id, is_locked in cr.fetchall():
+            if is_locked:
+                locked.append(message_id)
+            else:
+                busy.add(message_id)
+        if locked:
+            # another transaction may have committed the message after our
+            # snapshot was taken, so look in a new one
+            with registry(cr.dbname).cursor() as new_cr:
+                new_cr.execute(
+                    'select message_id from mail_message '
+                    'where message_id in %s', (tuple(locked),))
+                known.update(row[0] for row in new_cr.fetchall())
+        return known, busy
+
+    @api.model
+    def flag_message(self, connection, msgid, flag):
+        '''Set flag on message msgid. During a folder run, the flag is only
+        collected, to be stored together with the others at the end'''
+        flags = self.env.context.get('fetchmail_flag_buffer')
+        if flags is not None:
+            flags.add(msgid, flag)
+        else:
+            connection.uid('STORE', msgid, '+FLAGS', flag)
+
+    @api.model
+    def _run_stats(self):
+        '''Return the run_stats of the current folder run'''
+        return self.env.context.get('fetchmail_run_stats') or run_stats()
+
+    @api.model
+    def _mark_failed(self, msgids):
+        '''Remember that msgids could not be handled during a folder run, so
+        that the folder's last_uid stays below them'''
+        failed = self.env.context.get('fetchmail_failed_msgids')
+        if failed is not None:
+            failed.update(msgids)
+
+    @api.model
+    def _discard_flags(self, msgids):
+        flags = self.env.context.get('fetchmail_flag_buffer')
+        if flags is not None:
+            flags.discard(msgids)
+
     @api.multi
     def attach_mail(self, connection, object_id, folder, mail_message, msgid):
         '''Return ids of messages created'''
@@ -173,22 +789,11 @@ class fetchmail_server(models.Model):
                 partner_id = self.env[folder.model_id.model].browse(object_id)\
                     .partner_id.id
 
-            attachments = []
+            attachments = self.env['ir.attachment']
             if this.attach and mail_message.get('attachments'):
-                for attachment in mail_message['attachments']:
-                    fname, fcontent = attachment
-                    if isinstance(fcontent, unicode):
-                        fcontent = fcontent.encode('utf-8')
-                    data_attach = {
-                        'name': fname,
-                        'datas': base64.b64encode(str(fcontent)),
-                        'datas_fname': fname,
-                        'description': _('Mail attachment'),
-                        'res_model': folder.model_id.model,
-                        'res_id': object_id,
-                    }
-                    attachments.append(
-                        self.env['ir.attachment'].create(data_attach))
+                attachments = this.create_attachments(
+                    folder.model_id.model, object_id,
+                    mail_message['attachments'])
 
             mail_message_ids.append(
                 self.env['mail.message'].create({
@@ -201,26 +806,72 @@ class fetchmail_server(models.Model):
                     'email_from': mail_message.get('from'),
                     'date': mail_message.get('date'),
                     'message_id': mail_message.get('message_id'),
-                    'attachment_ids': [(6, 0, [a.id for a in attachments])],
+                    'attachment_ids': [(6, 0, attachments.ids)],
                 }))
 
             if folder.delete_matching:
-                connection.store(msgid, '+FLAGS', '\\DELETED')
+                this.flag_message(connection, msgid, '\\DELETED')
         return mail_message_ids
 
+    @api.model
+    def create_attachments(self, model, res_id, attachments):
+        '''Return ir.attachment records for a list of (filename, content).
+        With file storage, attachments with the same content on the same
+        record are reused, looked up for all attachments at once'''
+        ir_attachment = self.env['ir.attachment']
+        file_storage = ir_attachment._storage() == 'file'
+        contents = []
+        for fname, fcontent in attachments:
+            if isinstance(fcontent, unicode):
+                fcontent = fcontent.encode('utf-8')
+            store_fname = None
+            if file_storage:
+                store_fname = ir_attachment._get_path(fcontent)[0]
+            contents.append((fname, fcontent, store_fname))
+
+        attachment_ids = {}
+        store_fnames = tuple(set(
+            store_fname for dummy, dummy, store_fname in contents
+            if store_fname))
+        if store_fnames:
+            self.env.cr.execute(
+                'select store_fname, min(id) from ir_attachment '
+                'where res_model=%s and res_id=%s and store_fname in %s '
+                'group by store_fname',
+                (model, res_id, store_fnames))
+            attachment_ids = dict(self.env.cr.fetchall())
+
+        result = []
+        for fname, fcontent, store_fname in contents:
+            attachment_id = store_fname and attachment_ids.get(store_fname)
+            if not attachment_id:
+                # datas lets ir.attachment write the file and set file_size
+                attachment_id = ir_attachment.create({
+                    'name': fname,
+                    'datas': base64.b64encode(fcontent),
+                    'datas_fname': fname,
+                    'description': _('Mail attachment'),
+                    'res_model': model,
+                    'res_id': res_id,
+                }).id
+                if store_fname:
+                    attachment_ids[store_fname] = attachment_id
+            if attachment_id not in result:
+                result.append(attachment_id)
+        return ir_attachment.browse(result)
+
     def button_confirm_login(self, cr, uid, ids, context=None):
         retval = super(fetchmail_server, self).button_confirm_login(
             cr, uid, ids, context)
 
         for this in self.browse(cr, uid, ids, context):
             this.write({'state': 'draft'})
-            connection = this.connect()
-            connection.select()
-            for folder in this.folder_ids:
-                if connection.select(folder.path)[0] != 'OK':
-                    raise exceptions.ValidationError(
-                        _('Mailbox %s not found!') % folder.path)
-            connection.close()
+            with pool.connection(this) as connection:
+                connection.select()
+                for folder in this.folder_ids:
+                    if connection.select(folder.path)[0] != 'OK':
+                        raise exceptions.ValidationError(
+                            _('Mailbox %s not found!') % folder.path)
             this.write({'state': 'done'})
 
         return retval
@@ -231,34 +882,46 @@ class fetchmail_server(models.Model):
             cr, user, view_id, view_type, context, toolbar, submenu)
 
         if view_type == 'form':
-            view = etree.fromstring(
-                result['fields']['folder_ids']['views']['form']['arch'])
-            modifiers = {}
-            docstr = ''
-            for algorithm in self.pool['fetchmail.server.folder']\
-                    ._get_match_algorithms().itervalues():
-                for modifier in ['required', 'readonly']:
-                    for field in getattr(algorithm, modifier + '_fields'):
-                        modifiers.setdefault(field, {})
-                        modifiers[field].setdefault(modifier, [])
-                        if modifiers[field][modifier]:
-                            modifiers[field][modifier].insert(0, '|')
-                        modifiers[field][modifier].append(
-                            ("match_algorithm", "==", algorithm.__name__))
-                docstr += _(algorithm.name) + '\n' + _(algorithm.__doc__) + \
-                    '\n\n'
-
-            for field in view.xpath('//field'):
-                if field.tag == 'field' and field.get('name') in modifiers:
-                    field.set('modifiers', simplejson.dumps(
-                        dict(
-                            eval(field.attrib['modifiers'],
-                                 UnquoteEvalContext({})),
-                            **modifiers[field.attrib['name']])))
-                if (field.tag == 'field' and
-                        field.get('name') == 'match_algorithm'):
-                    field.set('help', docstr)
-            result['fields']['folder_ids']['views']['form']['arch'] = \
-                etree.tostring(view)
+            form = result['fields']['folder_ids']['views']['form']
+            key = (form['arch'], (context or {}).get('lang'),
+                   match_algorithm.base.algorithm_registry.version)
+            try:
+                form['arch'] = _folder_form_cache[key]
+            except KeyError:
+                arch = self._folder_form_arch(
+                    cr, user, form['arch'], context=context)
+                _folder_form_cache[key] = arch
+                form['arch'] = arch
 
         return result
+
+    def _folder_form_arch(self, cr, uid, arch, context=None):
+        '''Add the modifiers and help of the match algorithms to the folder
+        form'''
+        view = etree.fromstring(arch)
+        modifiers = {}
+        docstr = ''
+        for name, algorithm in sorted(
+                match_algorithm.base.algorithms.iteritems()):
+            for modifier in ['required', 'readonly']:
+                for field in getattr(algorithm, modifier + '_fields'):
+                    modifiers.setdefault(field, {})
+                    modifiers[field].setdefault(modifier, [])
+                    if modifiers[field][modifier]:
+                        modifiers[field][modifier].insert(0, '|')
+                    modifiers[field][modifier].append(
+                        ("match_algorithm", "==", name))
+            docstr += _(algorithm.name) + '\n' + _(algorithm.__doc__) + \
+                '\n\n'
+
+        for field in view.xpath('//field'):
+            if field.tag == 'field' and field.get('name') in modifiers:
+                field.set('modifiers', simplejson.dumps(
+                    dict(
+                        eval(field.attrib['modifiers'],
+                             UnquoteEvalContext({})),
+                        **modifiers[field.attrib['name']])))
+            if (field.tag == 'field' and
+                    field.get('name') == 'match_algorithm'):
+                field.set('help', docstr)
+        return etree.tostring(view)
@@ -19,8 +19,10 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ########################################################################
+import simplejson
 from openerp import api, models, fields
 from .. import match_algorithm
+from ..run_stats import STAGES
 
 
 class fetchmail_server_folder(models.Model):
@@ -28,14 +30,7 @@ class fetchmail_server_folder(models.Model):
     _rec_name = 'path'
 
     def _get_match_algorithms(self):
-        def get_all_subclasses(cls):
-            return (cls.__subclasses__() +
-                    [subsub
-                     for sub in cls.__subclasses__()
-                     for subsub in get_all_subclasses(sub)])
-        return dict([(cls.__name__, cls)
-                     for cls in get_all_subclasses(
-                         match_algorithm.base.base)])
+        return dict(match_algorithm.base.algorithms)
 
     def _get_match_algorithms_sel(self):
         algorithms = []
@@ -93,15 +88,140 @@ class fetchmail_server_folder(models.Model):
         'Message state',
         help='The state messages fetched from this folder should be '
         'assigned in Odoo')
+    fetch_batch_size = fields.Integer(
+        'Fetch batch size',
+        help='The number of messages to download with a single IMAP '
+        'command. Set to 0 or 1 to fetch messages one by one')
+    fetch_batch_bytes = fields.Integer(
+        'Fetch batch bytes',
+        help='The maximal size in bytes of the messages downloaded with a '
+        'single IMAP command, which are all held in memory at once. Bigger '
+        'messages are downloaded on their own. Set to 0 for no limit')
+    match_batch_size = fields.Integer(
+        'Match batch size',
+        help='The number of matched messages to store in the database at '
+        'once. If storing one of them fails, the batch is retried message '
+        'by message. Set to 0 or 1 to store messages one by one')
+    incremental_sync = fields.Boolean(
+        'Only fetch new messages',
+        help='Only process messages that arrived in the folder since the '
+        'last run. Uncheck this to check all messages on every run, ie to '
+        'retry matching messages that didn\'t match before')
+    idle = fields.Boolean(
+        'Push mode (IMAP IDLE)',
+        help='Keep a connection to the server open and check this folder as '
+        'soon as new mail arrives instead of waiting for the next scheduled '
+        'run. The server needs to support IMAP IDLE')
+    uidvalidity = fields.Char(
+        'UIDVALIDITY', readonly=True,
+        help='The IMAP UIDVALIDITY of the folder during the last run. If '
+        'this changes, the whole folder is checked again')
+    last_uid = fields.Char(
+        'Last UID', readonly=True,
+        help='The highest IMAP UID seen during the last run')
+    shards = fields.Integer(
+        'Worker processes',
+        help='Split the new messages of a run in this many ranges and handle '
+        'them in separate processes. Every process uses its own connection '
+        'and transaction and commits when done. Set to 0 or 1 to handle '
+        'all messages in the scheduler\'s process')
+    last_run_date = fields.Datetime('Last run', readonly=True)
+    last_run_duration = fields.Float(
+        'Duration (s)', readonly=True,
+        help='Seconds the last run took for this folder')
+    last_run_seen = fields.Integer(
+        'Messages seen', readonly=True,
+        help='New messages in the folder during the last run')
+    last_run_matched = fields.Integer('Matched', readonly=True)
+    last_run_duplicate = fields.Integer(
+        'Skipped as duplicate', readonly=True,
+        help='Messages skipped during the last run because they are in the '
+        'database already')
+    last_run_flagged = fields.Integer(
+        'Flagged', readonly=True,
+        help="Messages flagged during the last run because they didn't "
+        'match')
+    last_run_stats = fields.Text(
+        'Statistics', readonly=True,
+        help='Seconds spent per stage and counters of the last run as JSON')
 
     _defaults = {
         'flag_nonmatching': True,
         'msg_state': 'received',
+        'fetch_batch_size': 100,
+        'fetch_batch_bytes': 20 * 1024 * 1024,
+        'match_batch_size': 20,
+        'incremental_sync': True,
     }
 
     @api.multi
     def get_algorithm(self):
-        return self._get_match_algorithms()[self.match_algorithm]()
+        return match_algorithm.base.algorithms[self.match_algorithm]()
+
+    @api.multi
+    def button_reset_sync(self):
+        '''Check all messages in the folder again on the next run'''
+        self.write({'uidvalidity': False, 'last_uid': False})
+
+    @api.model
+    def _run_stats_values(self, stats):
+        '''Return values to write to remember a run_stats'''
+        summary = stats.as_dict()
+        return {
+            'last_run_date': fields.Datetime.now(),
+            'last_run_duration': summary['duration'],
+            'last_run_seen': summary['counters']['seen'],
+            'last_run_matched': summary['counters']['matched'],
+            'last_run_duplicate': summary['counters']['duplicate'],
+            'last_run_flagged': summary['counters']['flagged'],
+            'last_run_stats': simplejson.dumps(summary, sort_keys=True),
+        }
+
+    @api.model
+    def get_metrics(self):
+        '''Return the statistics of the last run of all folders in
+        Prometheus' text format'''
+        def labels(folder, **extra):
+            values = dict(extra, server=folder.server_id.name or '',
+                          folder=folder.path or '')
+            return ','.join(
+                '%s="%s"' % (
+                    key, values[key].replace('\\', '\\\\')
+                    .replace('"', '\\"').replace('\n', '\\n'))
+                for key in sorted(values))
+
+        folders = self.search([('last_run_date', '!=', False)])
+        lines = []
+        for name, field, description in [
+                ('duration_seconds', 'last_run_duration',
+                 'Duration of the last run'),
+                ('messages_seen', 'last_run_seen',
+                 'New messages during the last run'),
+                ('messages_matched', 'last_run_matched',
+                 'Messages matched during the last run'),
+                ('messages_duplicate', 'last_run_duplicate',
+                 'Messages skipped as duplicates during the last run'),
+                ('messages_flagged', 'last_run_flagged',
+                 'Messages flagged during the last run')]:
+            lines += [
+                '# HELP fetchmail_folder_%s %s' % (name, description),
+                '# TYPE fetchmail_folder_%s gauge' % name,
+            ]
+            for folder in folders:
+                lines.append('fetchmail_folder_%s{%s} %s' % (
+                    name, labels(folder), folder[field]))
+        lines += [
+            '# HELP fetchmail_folder_stage_seconds Seconds spent per stage '
+            'during the last run',
+            '# TYPE fetchmail_folder_stage_seconds gauge',
+        ]
+        for folder in folders:
+            stages = simplejson.loads(
+                folder.last_run_stats or '{}').get('stages', {})
+            for stage in STAGES:
+                lines.append('fetchmail_folder_stage_seconds{%s} %s' % (
+                    labels(folder, stage=stage), stages.get(stage, 0.0)))
+        return '\n'.join(lines) + '\n'
 
     @api.multi
     def button_attach_mail_manually(self):
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''Timers and counters for a folder run'''
+import time
+from contextlib import contextmanager
+
+STAGES = (
+    'search', 'headers', 'fetch', 'parse', 'dedup', 'match', 'handle',
+    'flags',
+)
+'''Stages of a folder run: searching for new messages, fetching headers to
+skip known messages, downloading messages, message_parse, checking for
+duplicates, search_matches, handle_match and storing flags'''
+
+COUNTERS = ('seen', 'matched', 'duplicate', 'flagged', 'failed')
+
+
+class run_stats(object):
+    '''Collects the time spent per stage and counts messages'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.timers = dict.fromkeys(STAGES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @contextmanager
+    def timer(self, stage):
+        '''Add the time spent in the with block to stage'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timers[stage] = self.timers.get(stage, 0.0) +\
+                time.time() - start
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def merge(self, summary):
+        '''Add the timers and counters of another run's as_dict()'''
+        for stage, seconds in summary['stages'].iteritems():
+            self.timers[stage] = self.timers.get(stage, 0.0) + seconds
+        for counter, amount in summary['counters'].iteritems():
+            self.count(counter, amount)
+
+    def duration(self):
+        return time.time() - self.start
+
+    def as_dict(self):
+        return {
+            'duration': self.duration(),
+            'stages': dict(self.timers),
+            'counters': dict(self.counters),
+        }
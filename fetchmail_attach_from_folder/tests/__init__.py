@@ -19,3 +19,6 @@
 #
 ##############################################################################
 from . import test_match_algorithms
+from . import test_imap_utils
+from . import test_fetchmail_server
+from . import test_benchmark
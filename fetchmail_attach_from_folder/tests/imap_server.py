@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''A minimal in memory IMAP server to test against. It only implements
+what this module uses, and doesn't care about authentication'''
+import email
+import email.utils
+import imaplib
+import re
+import select
+import SocketServer
+import threading
+import time
+
+BODY_SECTION = re.compile(
+    r'BODY(?P<peek>\.PEEK)?\[(?P<section>[^\]]*)\]', re.IGNORECASE)
+
+
+def quote(value):
+    '''Return value as IMAP string or NIL'''
+    if value is None:
+        return 'NIL'
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\r', '').replace('\n', '')
+
+
+def tokenize(line):
+    '''Split a command line in tokens. Parenthesized lists and bracketed
+    sections are returned as one token'''
+    tokens = []
+    token = ''
+    depth = 0
+    quoted = False
+    escaped = False
+    for char in line:
+        if quoted:
+            if escaped:
+                token += char
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                quoted = False
+            else:
+                token += char
+            continue
+        if char == '"' and not depth:
+            quoted = True
+        elif char in '([':
+            depth += 1
+            token += char
+        elif char in ')]':
+            depth -= 1
+            token += char
+        elif char == ' ' and not depth:
+            tokens.append(token)
+            token = ''
+        else:
+            token += char
+    tokens.append(token)
+    return [item for item in tokens if item]
+
+
+def sequence_set(spec, maximum):
+    '''Return the numbers in an IMAP sequence set'''
+    result = set()
+    for part in spec.split(','):
+        if ':' in part:
+            start, stop = part.split(':')
+        else:
+            start = stop = part
+        start = maximum if start == '*' else int(start)
+        stop = maximum if stop == '*' else int(stop)
+        result.update(range(min(start, stop), max(start, stop) + 1))
+    return result
+
+
+class Message(object):
+    def __init__(self, uid, data, flags=None, internaldate=None):
+        self.uid = uid
+        self.data = data
+        self.flags = set(flags or [])
+        self.internaldate = internaldate or time.time()
+        self.parsed = email.message_from_string(data)
+
+    def header(self, fields):
+        lines = []
+        for name, value in self.parsed.items():
+            if name.upper() in fields:
+                lines.append('%s: %s' % (name, value))
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def envelope(self):
+        def addresses(name):
+            values = self.parsed.get_all(name)
+            if not values:
+                return 'NIL'
+            return '(%s)' % ''.join(
+                '(%s NIL %s %s)' % (
+                    quote(realname or None),
+                    quote(address.split('@')[0]),
+                    quote(address.split('@')[-1]))
+                for realname, address in email.utils.getaddresses(values))
+        return '(%s)' % ' '.join([
+            quote(self.parsed.get('Date')),
+            quote(self.parsed.get('Subject')),
+            addresses('From'),
+            addresses('Sender') if self.parsed.get('Sender')
+            else addresses('From'),
+            addresses('Reply-To') if self.parsed.get('Reply-To')
+            else addresses('From'),
+            addresses('To'),
+            addresses('Cc'),
+            addresses('Bcc'),
+            quote(self.parsed.get('In-Reply-To')),
+            quote(self.parsed.get('Message-Id')),
+        ])
+
+
+class Mailbox(object):
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+
+
+class ImapHandler(SocketServer.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.mailbox = None
+        self.send('* OK IMAP4rev1 test server ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip('\r\n')
+            parts = line.split(' ', 2)
+            tag = parts[0]
+            command = parts[1].upper() if len(parts) > 1 else ''
+            args = tokenize(parts[2]) if len(parts) > 2 else []
+            self.server.log_command(command, args)
+            try:
+                if not getattr(self, 'do_' + command, None):
+                    self.send('%s BAD unknown command' % tag)
+                    continue
+                with self.server.lock:
+                    result = getattr(self, 'do_' + command)(tag, args)
+                if command == 'IDLE':
+                    self.idle(tag)
+                    continue
+                self.send('%s %s' % (tag, result or 'OK done'))
+                if command == 'LOGOUT':
+                    return
+            except Exception as e:
+                self.send('%s BAD %s' % (tag, e))
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY IMAP4rev1 IDLE UIDPLUS')
+
+    def do_LOGIN(self, tag, args):
+        self.server.logins += 1
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE logging out')
+
+    def do_NOOP(self, tag, args):
+        pass
+
+    def do_SELECT(self, tag, args):
+        mailbox = self.server.mailboxes.get(args[0] if args else '')
+        if mailbox is None:
+            self.mailbox = None
+            return 'NO no such mailbox'
+        self.mailbox = mailbox
+        self.send('* %d EXISTS' % len(mailbox.messages))
+        self.send('* OK [UIDVALIDITY %d] UIDs valid' % mailbox.uidvalidity)
+        self.send('* OK [UIDNEXT %d] next uid' % mailbox.uidnext)
+        return 'OK [READ-WRITE] selected'
+
+    do_EXAMINE = do_SELECT
+
+    def do_CLOSE(self, tag, args):
+        self._expunge(silent=True)
+        self.mailbox = None
+
+    def do_EXPUNGE(self, tag, args):
+        self._expunge()
+
+    def _expunge(self, silent=False):
+        for seq in reversed(range(len(self.mailbox.messages))):
+            if '\\Deleted' in self.mailbox.messages[seq].flags:
+                del self.mailbox.messages[seq]
+                if not silent:
+                    self.send('* %d EXPUNGE' % (seq + 1))
+
+    def _messages(self, spec, uid):
+        '''Return (seq, message) for messages in a sequence set'''
+        messages = self.mailbox.messages
+        if uid:
+            uids = sequence_set(
+                spec, messages[-1].uid if messages else 0)
+            return [(seq + 1, message)
+                    for seq, message in enumerate(messages)
+                    if message.uid in uids]
+        seqs = sequence_set(spec, len(messages))
+        return [(seq + 1, message)
+                for seq, message in enumerate(messages)
+                if seq + 1 in seqs]
+
+    def do_SEARCH(self, tag, args, uid=False):
+        result = self._messages('1:*', False)
+        args = list(args)
+        while args:
+            criterion = args.pop(0).upper()
+            if criterion == 'ALL':
+                continue
+            elif criterion in ('DELETED', 'FLAGGED', 'SEEN'):
+                flag = '\\' + criterion.capitalize()
+                result = [(seq, m) for seq, m in result if flag in m.flags]
+            elif criterion in ('UNDELETED', 'UNFLAGGED', 'UNSEEN'):
+                flag = '\\' + criterion[2:].capitalize()
+                result = [
+                    (seq, m) for seq, m in result if flag not in m.flags]
+            elif criterion == 'UID':
+                selected = set(
+                    m.uid for seq, m in self._messages(args.pop(0), True))
+                result = [(seq, m) for seq, m in result if m.uid in selected]
+            else:
+                selected = set(
+                    seq for seq, m in self._messages(criterion, False))
+                result = [(seq, m) for seq, m in result if seq in selected]
+        self.send('* SEARCH %s' % ' '.join(
+            str(m.uid if uid else seq) for seq, m in result))
+
+    def do_FETCH(self, tag, args, uid=False):
+        spec = args[1].strip('()')
+        for seq, message in self._messages(args[0], uid):
+            items = []
+            if uid or re.search(r'\bUID\b', spec, re.IGNORECASE):
+                items.append('UID %d' % message.uid)
+            for section in BODY_SECTION.finditer(spec):
+                fields = re.search(
+                    r'\((.*)\)', section.group('section'))
+                if fields:
+                    data = message.header(fields.group(1).upper().split())
+                else:
+                    data = message.data
+                items.append('BODY[%s] {%d}\r\n%s' % (
+                    section.group('section'), len(data), data))
+            spec_rest = BODY_SECTION.sub('', spec).upper().split()
+            if 'FLAGS' in spec_rest:
+                items.append('FLAGS (%s)' % ' '.join(sorted(message.flags)))
+            if 'INTERNALDATE' in spec_rest:
+                items.append('INTERNALDATE %s' % imaplib.Time2Internaldate(
+                    message.internaldate))
+            if 'RFC822.SIZE' in spec_rest:
+                items.append('RFC822.SIZE %d' % len(message.data))
+            if 'ENVELOPE' in spec_rest:
+                items.append('ENVELOPE %s' % message.envelope())
+            if 'RFC822' in spec_rest:
+                items.append('RFC822 {%d}\r\n%s' % (
+                    len(message.data), message.data))
+            self.send('* %d FETCH (%s)' % (seq, ' '.join(items)))
+
+    def do_STORE(self, tag, args, uid=False):
+        mode = args[1].upper()
+        # flags are case insensitive
+        flags = [
+            flag.capitalize() if not flag.startswith('\\')
+            else '\\' + flag[1:].capitalize()
+            for flag in args[2].strip('()').split()
+        ]
+        for seq, message in self._messages(args[0], uid):
+            if mode.startswith('+'):
+                message.flags.update(flags)
+            elif mode.startswith('-'):
+                message.flags.difference_update(flags)
+            else:
+                message.flags = set(flags)
+            if not mode.endswith('.SILENT'):
+                self.send('* %d FETCH (FLAGS (%s))' % (
+                    seq, ' '.join(sorted(message.flags))))
+
+    def do_UID(self, tag, args):
+        command = args[0].upper()
+        if command not in ('SEARCH', 'FETCH', 'STORE'):
+            return 'BAD unsupported UID command'
+        getattr(self, 'do_' + command)(tag, args[1:], uid=True)
+
+    def do_IDLE(self, tag, args):
+        self.send('+ idling')
+
+    def idle(self, tag):
+        known = len(self.mailbox.messages) if self.mailbox else 0
+        while True:
+            if select.select([self.rfile], [], [], .05)[0]:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == 'DONE':
+                    break
+            with self.server.lock:
+                exists = len(self.mailbox.messages) if self.mailbox else 0
+            if exists > known:
+                self.send('* %d EXISTS' % exists)
+                known = exists
+        self.send('%s OK IDLE terminated' % tag)
+
+
+class ImapServer(SocketServer.ThreadingTCPServer):
+    '''Run with start(), add mail with append(), stop with stop()'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), ImapHandler)
+        self.lock = threading.RLock()
+        self.mailboxes = {'INBOX': Mailbox()}
+        self.logins = 0
+        self.commands = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def log_command(self, command, args):
+        with self.lock:
+            self.commands.append(
+                ' '.join([command] + args[:1]) if command == 'UID'
+                else command)
+
+    def append(self, path, data, flags=None):
+        '''Add a message to a mailbox, return its uid'''
+        with self.lock:
+            mailbox = self.mailboxes.setdefault(path, Mailbox())
+            message = Message(mailbox.uidnext, data, flags=flags)
+            mailbox.uidnext += 1
+            mailbox.messages.append(message)
+            return message.uid
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
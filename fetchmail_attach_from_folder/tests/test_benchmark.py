@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''Throughput benchmarks, only run if FETCHMAIL_BENCHMARK is set to the
+amount of messages to process, ie
+
+FETCHMAIL_BENCHMARK=1000 FETCHMAIL_BENCHMARK_SIZES=0,100000 \\
+    openerp-server -d db -u fetchmail_attach_from_folder --test-enable
+
+FETCHMAIL_BENCHMARK_SIZES are the attachment sizes in bytes to test with.
+Results are logged for every scenario, memory use is sampled during every
+scenario on systems having /proc'''
+import logging
+import os
+import resource
+import threading
+import time
+import unittest
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from openerp.tests.common import TransactionCase
+from openerp.addons.fetchmail_attach_from_folder.imap_pool import pool
+from .imap_server import ImapServer
+_logger = logging.getLogger(__name__)
+
+MESSAGES = int(os.environ.get('FETCHMAIL_BENCHMARK') or 0)
+SIZES = [
+    int(size) for size in
+    (os.environ.get('FETCHMAIL_BENCHMARK_SIZES') or '0').split(',')
+]
+PARTNERS = 100
+'''Amount of partners to match against'''
+RSS_INTERVAL = 0.01
+'''Seconds between samples of the memory use of a scenario'''
+
+
+def current_rss():
+    '''Return the current resident set size of the process in kB, None if
+    the system doesn't tell'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+class RssSampler(threading.Thread):
+    '''Samples current_rss until stopped and keeps the highest value, to
+    measure the peak memory use of a single scenario'''
+
+    def __init__(self):
+        super(RssSampler, self).__init__()
+        self.daemon = True
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+@unittest.skipUnless(MESSAGES, 'Set FETCHMAIL_BENCHMARK to run benchmarks')
+class TestBenchmark(TransactionCase):
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.imap = ImapServer().start()
+        self.partners = self.env['res.partner']
+        for i in range(PARTNERS):
+            self.partners += self.partners.create({
+                'name': 'Benchmark partner %d' % i,
+                'email': 'benchmark%d@example.com' % i,
+                'ref': 'BENCH%05d' % i,
+            })
+        self.servers = self.env['fetchmail.server']
+
+    def tearDown(self):
+        for server in self.servers:
+            pool.clear(server)
+        self.imap.stop()
+        super(TestBenchmark, self).tearDown()
+
+    def create_server(self, path, match_algorithm):
+        server = self.env['fetchmail.server'].create({
+            'name': 'Benchmark %s' % path,
+            'server': '127.0.0.1',
+            'port': self.imap.port,
+            'type': 'imap',
+            'is_ssl': False,
+            'user': 'user',
+            'password': 'password',
+            'folder_ids': [(0, 0, {
+                'path': path,
+                'model_id': self.env.ref('base.model_res_partner').id,
+                'model_field':
+                'email' if match_algorithm != 'token_score' else 'ref',
+                'mail_field':
+                'from' if match_algorithm != 'token_score' else 'subject',
+                'match_algorithm': match_algorithm,
+                'match_first': True,
+                'domain': "[('name', 'like', 'Benchmark partner')]",
+            })],
+        })
+        self.servers += server
+        return server
+
+    def fill_mailbox(self, path, size):
+        '''Put MESSAGES messages with an attachment of size bytes into
+        path'''
+        for i in range(MESSAGES):
+            message = MIMEMultipart()
+            message['Message-Id'] = '<benchmark-%s-%d@test>' % (path, i)
+            message['From'] = 'benchmark%d@example.com' % (i % PARTNERS)
+            message['To'] = 'archive@example.com'
+            message['Subject'] = 'Order BENCH%05d number %d' % (
+                i % PARTNERS, i)
+            message['Date'] = 'Mon, 29 Jun 2015 10:00:00 +0000'
+            message.attach(MIMEText('Benchmark message %d' % i))
+            if size:
+                attachment = MIMEApplication(os.urandom(size))
+                attachment.add_header(
+                    'Content-Disposition', 'attachment',
+                    filename='attachment%d.bin' % i)
+                message.attach(attachment)
+            self.imap.append(path, message.as_string())
+
+    def measure(self, label, function):
+        '''Run function and log messages per second, queries and the peak
+        memory use during the call, relative to the memory use before it.
+        The process wide maximum is logged too, it doesn't go down between
+        scenarios'''
+        cr = self.env.cr
+        queries = getattr(cr, 'sql_log_count', 0)
+        rss = current_rss()
+        sampler = RssSampler()
+        if rss is not None:
+            sampler.start()
+        start = time.time()
+        try:
+            function()
+        finally:
+            elapsed = max(time.time() - start, 1e-6)
+            peak_rss = sampler.stop() if rss is not None else None
+        _logger.info(
+            'benchmark %s: %d messages in %.2fs, %.1f messages/s, '
+            '%d queries, %s, process max rss %d kB',
+            label, MESSAGES, elapsed, MESSAGES / elapsed,
+            getattr(cr, 'sql_log_count', 0) - queries,
+            'peak rss %d kB (+%d kB)' % (peak_rss, peak_rss - rss)
+            if rss is not None else 'peak rss unknown',
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def test_fetch_mail(self):
+        for match_algorithm in [
+                'email_exact', 'token_score', 'openerp_standard']:
+            for size in SIZES:
+                path = 'INBOX.%s.%d' % (match_algorithm, size)
+                self.fill_mailbox(path, size)
+                server = self.create_server(path, match_algorithm)
+                self.measure(
+                    'fetch_mail %s, attachments of %d bytes' % (
+                        match_algorithm, size),
+                    server.fetch_mail)
+
+    def test_handle_folder(self):
+        for size in SIZES:
+            path = 'INBOX.handle_folder.%d' % size
+            self.fill_mailbox(path, size)
+            server = self.create_server(path, 'email_exact')
+
+            def handle_folder():
+                with pool.connection(server) as connection:
+                    server.handle_folder(connection, server.folder_ids)
+
+            self.measure(
+                'handle_folder, attachments of %d bytes' % size,
+                handle_folder)
+
+    def test_attach_mail_manually(self):
+        for size in SIZES:
+            path = 'INBOX.wizard.%d' % size
+            self.fill_mailbox(path, size)
+            server = self.create_server(path, 'email_exact')
+            wizard_model = self.env['fetchmail.attach.mail.manually']\
+                .with_context(
+                    default_folder_id=server.folder_ids.id,
+                    default_page_size=MESSAGES)
+            wizards = []
+
+            def open_wizard():
+                wizards.append(wizard_model.create(wizard_model.default_get([
+                    'folder_id', 'mail_ids', 'page_size', 'pending_msgids',
+                ])))
+
+            self.measure(
+                'open attach wizard, attachments of %d bytes' % size,
+                open_wizard)
+            for mail in wizards[-1].mail_ids:
+                mail.object_id = self.partners[
+                    (int(mail.msgid) - 1) % PARTNERS]
+            self.measure(
+                'attach_mails, attachments of %d bytes' % size,
+                wizards[-1].attach_mails)
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import threading
+import time
+from openerp.tests.common import TransactionCase
+from openerp.addons.fetchmail_attach_from_folder.imap_pool import pool
+from openerp.addons.fetchmail_attach_from_folder.imap_utils import idle
+from openerp.addons.fetchmail_attach_from_folder.match_algorithm.\
+    email_exact import email_exact
+from openerp.addons.fetchmail_attach_from_folder.model.fetchmail_server\
+    import MESSAGE_ID_LOCK, fetchmail_server
+from openerp.addons.fetchmail_attach_from_folder.run_stats import run_stats
+from .imap_server import ImapServer
+
+MAIL_TEMPLATE = (
+    'Message-Id: <%(message_id)s@test>\r\n'
+    'From: %(email_from)s\r\n'
+    'To: archive@example.com\r\n'
+    'Subject: %(subject)s\r\n'
+    'Date: Mon, 29 Jun 2015 10:00:00 +0000\r\n'
+    '\r\n'
+    'Hello world\r\n'
+)
+
+
+class TestFetchmailServer(TransactionCase):
+    def setUp(self):
+        super(TestFetchmailServer, self).setUp()
+        self.imap = ImapServer().start()
+        self.partner = self.env['res.partner'].create({
+            'name': 'Testpartner',
+            'email': 'testpartner@example.com',
+        })
+        self.server = self.env['fetchmail.server'].create({
+            'name': 'Test server',
+            'server': '127.0.0.1',
+            'port': self.imap.port,
+            'type': 'imap',
+            'is_ssl': False,
+            'user': 'user',
+            'password': 'password',
+            'folder_ids': [(0, 0, {
+                'path': 'INBOX',
+                'model_id': self.env.ref('base.model_res_partner').id,
+                'model_field': 'email',
+                'match_algorithm': 'email_exact',
+                'mail_field': 'from',
+                'delete_matching': True,
+            })],
+        })
+
+    def tearDown(self):
+        pool.clear(self.server)
+        self.imap.stop()
+        super(TestFetchmailServer, self).tearDown()
+
+    def append_mail(self, message_id, email_from='testpartner@example.com',
+                    subject='Testsubject'):
+        return self.imap.append('INBOX', MAIL_TEMPLATE % {
+            'message_id': message_id,
+            'email_from': email_from,
+            'subject': subject,
+        })
+
+    def test_fetch_mail(self):
+        self.append_mail('1', subject='Testsubject 1')
+        self.append_mail('2', email_from='unknown@example.com')
+        self.server.fetch_mail()
+        self.assertEqual(
+            self.partner.message_ids.mapped('subject'), ['Testsubject 1'])
+        messages = self.imap.mailboxes['INBOX'].messages
+        self.assertEqual(len(messages), 1)
+        self.assertIn('\\Flagged', messages[0].flags)
+        # flags are stored with one command per flag
+        self.assertEqual(self.imap.commands.count('UID STORE'), 2)
+        folder = self.server.folder_ids
+        self.assertEqual(folder.last_uid, '2')
+        self.assertEqual(
+            (folder.last_run_seen, folder.last_run_matched,
+             folder.last_run_duplicate, folder.last_run_flagged),
+            (2, 1, 0, 1))
+        self.assertIn(
+            'fetchmail_folder_messages_matched{folder="INBOX",'
+            'server="Test server"} 1',
+            folder.get_metrics())
+        # the second run reuses the connection and only checks new mail
+        self.append_mail('3', subject='Testsubject 3')
+        self.server.fetch_mail()
+        self.assertEqual(self.imap.logins, 1)
+        self.assertEqual(
+            sorted(self.partner.message_ids.mapped('subject')),
+            ['Testsubject 1', 'Testsubject 3'])
+        self.assertEqual(folder.last_uid, '3')
+
+    def test_fetch_batch_bytes(self):
+        for message_id in range(3):
+            self.append_mail(str(message_id))
+        folder = self.server.folder_ids
+        folder.fetch_batch_bytes = 1
+        self.server.fetch_mail()
+        self.assertEqual(len(self.partner.message_ids), 3)
+        # headers at once, then every message on its own
+        self.assertEqual(self.imap.commands.count('UID FETCH'), 4)
+
+    def test_retry_failed(self):
+        self.append_mail('1', subject='Testsubject 1')
+        self.append_mail('2', subject='Testsubject 2')
+        handle_match = email_exact.handle_match
+
+        def failing_handle_match(self, cr, uid, connection, object_id,
+                                 folder, mail_message, *args, **kwargs):
+            if mail_message['subject'] == 'Testsubject 1':
+                raise Exception('Failing on purpose')
+            return handle_match(
+                self, cr, uid, connection, object_id, folder, mail_message,
+                *args, **kwargs)
+
+        email_exact.handle_match = failing_handle_match
+        try:
+            self.server.fetch_mail()
+        finally:
+            email_exact.handle_match = handle_match
+        folder = self.server.folder_ids
+        self.assertEqual(
+            self.partner.message_ids.mapped('subject'), ['Testsubject 2'])
+        self.assertEqual(folder.last_uid, '0')
+        # the next run handles the failed message
+        self.server.fetch_mail()
+        self.assertEqual(
+            sorted(self.partner.message_ids.mapped('subject')),
+            ['Testsubject 1', 'Testsubject 2'])
+        self.assertEqual(folder.last_uid, '1')
+
+    def test_duplicate_message_id(self):
+        self.append_mail('1')
+        self.append_mail('1')
+        folder = self.server.folder_ids
+        with pool.connection(self.server) as connection:
+            connection.select(folder.path)
+            self.assertEqual(
+                self.server.filter_known_msgids(
+                    connection, folder, ['1', '2']),
+                ['1'])
+
+    def test_shards(self):
+        for message_id in range(5):
+            self.append_mail(str(message_id))
+        folder = self.server.folder_ids
+        folder.shards = 2
+        chunks = self.server._split_shards(folder, ['1', '2', '3', '4', '5'])
+        self.assertEqual(chunks, [['1', '2', '3'], ['4', '5']])
+        stats = run_stats()
+        failed = set()
+        server = self.server.with_context(
+            fetchmail_run_stats=stats, fetchmail_failed_msgids=failed)
+        # the second shard died without reporting
+        matched_object_ids, expunge = server._merge_shards(chunks, {
+            0: self.server._run_shard(folder, chunks[0]),
+        })
+        self.assertEqual(matched_object_ids, [self.partner.id] * 3)
+        self.assertTrue(expunge)
+        self.assertEqual(failed, set(['4', '5']))
+        self.assertEqual(
+            (stats.counters['matched'], stats.counters['failed']), (3, 2))
+
+    def test_shard_timeout(self):
+        self.env['ir.config_parameter'].set_param(
+            'fetchmail_attach_from_folder.shard_timeout', '1')
+        folder = self.server.folder_ids
+        folder.shards = 2
+        stats = run_stats()
+        failed = set()
+
+        def hanging_shard(*args):
+            time.sleep(600)
+
+        _handle_shard = fetchmail_server._handle_shard
+        fetchmail_server._handle_shard = hanging_shard
+        start = time.time()
+        try:
+            self.assertEqual(
+                self.server.with_context(
+                    fetchmail_run_stats=stats, fetchmail_failed_msgids=failed,
+                ).handle_shards(folder, ['1', '2', '3']),
+                ([], False))
+        finally:
+            fetchmail_server._handle_shard = _handle_shard
+        self.assertLess(time.time() - start, 60)
+        self.assertEqual(failed, set(['1', '2', '3']))
+
+    def test_claim_message_ids(self):
+        self.env['mail.message'].create({'message_id': '<known@test>'})
+        with self.registry.cursor() as cr:
+            # another transaction storing a message right now
+            cr.execute(
+                'select pg_advisory_xact_lock(%s, hashtext(%s))',
+                (MESSAGE_ID_LOCK, '<busy@test>'))
+            known, busy = self.server._claim_message_ids(
+                ['<known@test>', '<busy@test>', '<new@test>', False])
+        self.assertEqual(known, set(['<known@test>']))
+        self.assertEqual(busy, set(['<busy@test>']))
+
+    def test_create_attachments(self):
+        attachments = self.server.create_attachments(
+            'res.partner', self.partner.id,
+            [('a.txt', 'hello world'), ('b.txt', 'hello world'),
+             ('c.txt', u'h\xe9llo')])
+        self.assertEqual(len(attachments), 2)
+        self.assertEqual(
+            attachments[0].datas.decode('base64'), 'hello world')
+        self.assertEqual(
+            attachments[1].datas.decode('base64'), u'h\xe9llo'.encode('utf-8'))
+        self.assertEqual(attachments.mapped('file_size'), [11, 6])
+        self.assertEqual(
+            self.server.create_attachments(
+                'res.partner', self.partner.id, [('d.txt', 'hello world')]),
+            attachments[0])
+
+    def test_attach_mail_manually(self):
+        for message_id in range(3):
+            self.append_mail(
+                str(message_id), email_from='unknown@example.com',
+                subject='Manual %d' % message_id)
+        wizard_model = self.env['fetchmail.attach.mail.manually']\
+            .with_context(
+                default_folder_id=self.server.folder_ids.id,
+                default_page_size=2)
+        wizard = wizard_model.create(wizard_model.default_get([
+            'folder_id', 'mail_ids', 'page_size', 'pending_msgids']))
+        self.assertEqual(
+            wizard.mail_ids.mapped('subject'), ['Manual 2', 'Manual 1'])
+        self.assertTrue(wizard.has_more)
+        wizard.button_load_more()
+        self.assertEqual(len(wizard.mail_ids), 3)
+        self.assertFalse(wizard.has_more)
+        wizard.mail_ids.filtered(lambda x: x.subject == 'Manual 0').write({
+            'object_id': 'res.partner,%d' % self.partner.id,
+        })
+        wizard.attach_mails()
+        self.assertEqual(
+            self.partner.message_ids.mapped('subject'), ['Manual 0'])
+
+    def test_idle(self):
+        connection = pool.acquire(self.server)
+        connection.select('INBOX')
+        threading.Timer(.2, self.append_mail, ('1',)).start()
+        self.assertTrue(idle(connection, 5))
+        self.assertFalse(idle(connection, .1))
+        pool.release(self.server, connection)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    This module copyright (C) 2015 Therp BV (<http://therp.nl>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp.tests.common import TransactionCase
+from openerp.addons.fetchmail_attach_from_folder.imap_utils import (
+    chunked, chunked_by_size, message_set, parse_fetch_items,
+    parse_fetch_response, parse_fetch_sizes)
+
+
+class TestImapUtils(TransactionCase):
+    def test_chunked(self):
+        self.assertEqual(
+            list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+    def test_chunked_by_size(self):
+        sizes = {'1': 10, '2': 10, '3': 50, '4': 5}
+        self.assertEqual(
+            list(chunked_by_size(['1', '2', '3', '4', '5'], 3, 30, sizes)),
+            [['1', '2'], ['3'], ['4', '5']])
+        self.assertEqual(
+            list(chunked_by_size(['1', '2', '3', '4'], 3, 0, sizes)),
+            [['1', '2', '3'], ['4']])
+
+    def test_message_set(self):
+        self.assertEqual(message_set(['1', '2', '3', '5']), '1:3,5')
+        self.assertEqual(message_set(['7', '3', '4', '3']), '3:4,7')
+        self.assertEqual(message_set(['42']), '42')
+
+    def test_parse_fetch_response(self):
+        data = [
+            ('1 (UID 11 RFC822 {5}', 'mail1'),
+            ')',
+            '2 (FLAGS (\\Seen))',
+            ('2 (RFC822 {5}', 'mail2'),
+            ' UID 12)',
+            ('3 (RFC822 {5}', 'mail3'),
+            ')',
+        ]
+        self.assertEqual(
+            list(parse_fetch_response(data)),
+            [
+                ('1', '11', 'mail1'),
+                ('2', '12', 'mail2'),
+                ('3', None, 'mail3'),
+            ])
+
+    def test_parse_fetch_sizes(self):
+        data = [
+            ('1 (UID 11 RFC822.SIZE 1234 BODY[HEADER] {5}', 'head1'),
+            ')',
+            ('2 (UID 12 BODY[HEADER] {5}', 'head2'),
+            ' RFC822.SIZE 42)',
+        ]
+        self.assertEqual(parse_fetch_sizes(data), {'11': 1234, '12': 42})
+
+    def test_parse_fetch_items(self):
+        data = [
+            ('1 (UID 11 ENVELOPE (NIL {7}', 'a "(b)"'),
+            ' NIL NIL NIL ((NIL NIL "to" "example.com")) NIL NIL NIL NIL)'
+            ' INTERNALDATE "29-Jun-2015 10:00:00 +0000")',
+            '2 (UID 12 ENVELOPE (NIL "say \\"hi\\"" NIL NIL NIL NIL NIL NIL'
+            ' NIL NIL))',
+        ]
+        items = list(parse_fetch_items(data))
+        self.assertEqual([seq for seq, values in items], ['1', '2'])
+        self.assertEqual(items[0][1]['UID'], '11')
+        self.assertEqual(items[0][1]['ENVELOPE'][1], 'a "(b)"')
+        self.assertEqual(
+            items[0][1]['ENVELOPE'][5], [[None, None, 'to', 'example.com']])
+        self.assertEqual(
+            items[0][1]['INTERNALDATE'], '29-Jun-2015 10:00:00 +0000')
+        self.assertEqual(items[1][1]['ENVELOPE'][1], 'say "hi"')
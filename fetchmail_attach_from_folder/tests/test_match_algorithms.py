@@ -21,7 +21,7 @@
 from openerp import models
 from openerp.tests.common import TransactionCase
 from openerp.addons.fetchmail_attach_from_folder.match_algorithm import (
-    email_exact, email_domain, openerp_standard)
+    email_exact, email_domain, openerp_standard, token_score)
 
 
 class TestMatchAlgorithms(TransactionCase):
@@ -56,6 +56,32 @@ class TestMatchAlgorithms(TransactionCase):
             self.env.ref('base.user_demo_res_partner').message_ids.subject,
             mail_message['subject'])
 
+    def test_email_exact_order(self):
+        partner1 = self.env['res.partner'].create({
+            'name': 'Testpartner 1',
+            'email': 'Same@Example.com',
+        })
+        partner2 = self.env['res.partner'].create({
+            'name': 'Testpartner 2',
+            'email': 'same@example.com',
+        })
+        conf = self.env['fetchmail.server.folder'].browse([models.NewId()])
+        conf.model_id = self.env.ref('base.model_res_partner').id
+        conf.model_field = 'email'
+        conf.model_order = 'id desc'
+        conf.match_algorithm = 'email_exact'
+        conf.mail_field = 'from'
+        matcher = email_exact.email_exact()
+        matches = matcher.search_matches(
+            self.env.cr, self.env.uid, conf,
+            {'from': 'Someone <same@example.com>'}, None)
+        self.assertEqual(matches, [partner2.id, partner1.id])
+        matcher = email_domain.email_domain()
+        matches = matcher.search_matches(
+            self.env.cr, self.env.uid, conf,
+            {'from': 'someone.else@example.com'}, None)
+        self.assertEqual(matches[:2], [partner2.id, partner1.id])
+
     def test_email_domain(self):
         mail_message = {
             'subject': 'Testsubject',
@@ -101,3 +127,72 @@ class TestMatchAlgorithms(TransactionCase):
             'Hello world',
             self.env['mail.message']
                 .search([('subject', '=', 'testsubject')]).body)
+
+    def test_token_score(self):
+        partner = self.env['res.partner'].create({
+            'name': 'Zyxwvut Holding',
+            'ref': 'CUST0042',
+        })
+        partner2 = self.env['res.partner'].create({
+            'name': 'Zyxwvut Trading',
+            'ref': 'CUST0043',
+        })
+        mail_message = {
+            'subject': 'Your order for cust0042',
+            'body': '<p>Regards, <b>zyxwvut</b> holding</p>',
+        }
+        conf = self.env['fetchmail.server.folder'].browse([models.NewId()])
+        conf.model_id = self.env.ref('base.model_res_partner').id
+        conf.model_field = 'name,ref'
+        conf.match_algorithm = 'token_score'
+        conf.mail_field = 'subject,body'
+        conf.domain = "[('name', 'like', 'Zyxwvut')]"
+        conf.server_id = self.env['fetchmail.server'].browse([models.NewId()])
+        matcher = token_score.token_score()
+        self.assertEqual(
+            matcher.search_matches(
+                self.env.cr, self.env.uid, conf, mail_message, None),
+            [partner.id])
+        # headers of the original message can be used too
+        conf.mail_field = 'x-customer'
+        self.assertEqual(
+            matcher.search_matches(
+                self.env.cr, self.env.uid, conf, {},
+                'X-Customer: CUST0043\n\nHello'),
+            [partner2.id])
+        # sharing only a common word is not enough
+        jackson = self.env['res.partner'].create({
+            'name': 'The Jackson Group',
+        })
+        conf.model_field = 'name'
+        conf.mail_field = 'subject'
+        conf.domain = "[('id', 'in', %s)]" % ([partner.id, jackson.id],)
+        matcher = token_score.token_score()
+        self.assertEqual(
+            matcher.search_matches(
+                self.env.cr, self.env.uid, conf,
+                {'subject': 'The weather is fine'}, None),
+            [])
+        self.assertEqual(
+            matcher.search_matches(
+                self.env.cr, self.env.uid, conf,
+                {'subject': 'Meeting with the Jackson Group'}, None),
+            [jackson.id])
+
+    def test_registry(self):
+        self.assertEqual(
+            self.env['fetchmail.server.folder']._get_match_algorithms(),
+            {
+                'email_exact': email_exact.email_exact,
+                'email_domain': email_domain.email_domain,
+                'openerp_standard': openerp_standard.openerp_standard,
+                'token_score': token_score.token_score,
+            })
+        server_model = self.env['fetchmail.server']
+        arch = server_model.fields_view_get(view_type='form')['fields'][
+            'folder_ids']['views']['form']['arch']
+        self.assertIn('email_domain', arch)
+        self.assertIs(
+            server_model.fields_view_get(view_type='form')['fields'][
+                'folder_ids']['views']['form']['arch'],
+            arch)
@@ -19,7 +19,14 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
-from openerp import fields, models
+import imaplib
+import time
+from datetime import datetime
+from openerp import api, fields, models
+from openerp.addons.mail.mail_message import decode
+from ..imap_pool import pool
+from ..imap_utils import chunked, flag_buffer, message_set,\
+    parse_fetch_items, parse_fetch_response
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -31,6 +38,17 @@ class attach_mail_manually(models.TransientModel):
         'fetchmail.server.folder', 'Folder', readonly=True)
     mail_ids = fields.One2many(
         'fetchmail.attach.mail.manually.mail', 'wizard_id', 'Emails')
+    page_size = fields.Integer('Page size', default=50)
+    pending_msgids = fields.Text(
+        'Messages not loaded yet', readonly=True,
+        help='Space separated ids of the messages not listed yet')
+    has_more = fields.Boolean(compute='_compute_has_more')
+
+    @api.multi
+    @api.depends('pending_msgids')
+    def _compute_has_more(self):
+        for this in self:
+            this.has_more = bool((this.pending_msgids or '').split())
 
     def default_get(self, cr, uid, fields_list, context=None):
         if context is None:
@@ -39,63 +57,122 @@ class attach_mail_manually(models.TransientModel):
         defaults = super(attach_mail_manually, self).default_get(
             cr, uid, fields_list, context
         )
+        page_size = defaults.get('page_size') or 50
 
         for folder in self.pool.get('fetchmail.server.folder').browse(
                 cr, uid,
                 [context.get('default_folder_id')], context):
             defaults['mail_ids'] = []
-            connection = folder.server_id.connect()
-            connection.select(folder.path)
-            result, msgids = connection.search(
-                None,
-                'FLAGGED' if folder.flag_nonmatching else 'UNDELETED')
-            if result != 'OK':
-                _logger.error('Could not search mailbox %s on %s',
-                              folder.path, folder.server_id.name)
-                continue
-            for msgid in msgids[0].split():
-                result, msgdata = connection.fetch(msgid, '(RFC822)')
+            with pool.connection(folder.server_id) as connection:
+                connection.select(folder.path)
+                result, msgids = connection.uid(
+                    'SEARCH',
+                    'FLAGGED' if folder.flag_nonmatching else 'UNDELETED')
                 if result != 'OK':
-                    _logger.error('Could not fetch %s in %s on %s',
-                                  msgid, folder.path, folder.server_id.name)
+                    _logger.error('Could not search mailbox %s on %s',
+                                  folder.path, folder.server_id.name)
                     continue
-                mail_message = self.pool.get('mail.thread').message_parse(
-                    cr, uid, msgdata[0][1],
-                    save_original=folder.server_id.original,
-                    context=context
-                )
-                defaults['mail_ids'].append((0, 0, {
-                    'msgid': msgid,
-                    'subject': mail_message.get('subject', ''),
-                    'date': mail_message.get('date', ''),
-                    'object_id': '%s,-1' % folder.model_id.model,
-                }))
-            connection.close()
+                # newest messages first
+                msgids = list(reversed(msgids[0].split()))
+                defaults['mail_ids'] = [
+                    (0, 0, values) for values in self._list_mails(
+                        cr, uid, folder, connection, msgids[:page_size],
+                        context=context)
+                ]
+                defaults['pending_msgids'] = ' '.join(msgids[page_size:])
 
         return defaults
 
-    def attach_mails(self, cr, uid, ids, context=None):
-        for this in self.browse(cr, uid, ids, context):
-            for mail in this.mail_ids:
-                connection = this.folder_id.server_id.connect()
+    @api.model
+    def _list_mails(self, folder, connection, msgids):
+        '''Return values for wizard lines for msgids, fetching only envelope
+        and date of the messages'''
+        if not msgids:
+            return []
+        result, msgdata = connection.uid(
+            'FETCH', message_set(msgids), '(UID ENVELOPE INTERNALDATE)')
+        if result != 'OK':
+            _logger.error(
+                'Could not fetch %s in %s on %s',
+                message_set(msgids), folder.path, folder.server_id.name)
+            return []
+        mails = {}
+        for seq, items in parse_fetch_items(msgdata):
+            envelope = items.get('ENVELOPE') or []
+            date = False
+            if items.get('INTERNALDATE'):
+                date = fields.Datetime.to_string(datetime.utcfromtimestamp(
+                    time.mktime(imaplib.Internaldate2tuple(
+                        'INTERNALDATE "%s"' % items['INTERNALDATE']))))
+            mails[items.get('UID')] = {
+                'msgid': items.get('UID'),
+                'subject': decode(envelope[1] if len(envelope) > 1 else ''),
+                'date': date,
+                'object_id': '%s,-1' % folder.model_id.model,
+            }
+        return [mails[msgid] for msgid in msgids if msgid in mails]
+
+    @api.multi
+    def button_load_more(self):
+        '''Add the next page of messages to the list'''
+        for this in self:
+            msgids = (this.pending_msgids or '').split()
+            page_size = this.page_size or 50
+            with pool.connection(this.folder_id.server_id) as connection:
                 connection.select(this.folder_id.path)
-                result, msgdata = connection.fetch(mail.msgid, '(RFC822)')
-                if result != 'OK':
-                    _logger.error('Could not fetch %s in %s on %s',
-                                  mail.msgid, this.folder_id.path, this.server)
-                    continue
+                this.write({
+                    'mail_ids': [
+                        (0, 0, values) for values in this._list_mails(
+                            this.folder_id, connection, msgids[:page_size])
+                    ],
+                    'pending_msgids': ' '.join(msgids[page_size:]),
+                })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.ids[0],
+            'view_mode': 'form',
+            'target': 'new',
+            'context': self.env.context,
+        }
 
-                mail_message = self.pool.get('mail.thread').message_parse(
-                    cr, uid, msgdata[0][1],
-                    save_original=this.folder_id.server_id.original,
-                    context=context)
-
-                this.folder_id.server_id.attach_mail(
-                    connection,
-                    mail.object_id.id, this.folder_id, mail_message,
-                    mail.msgid
-                )
-                connection.close()
+    def attach_mails(self, cr, uid, ids, context=None):
+        for this in self.browse(cr, uid, ids, context):
+            flags = flag_buffer()
+            this = this.with_context(fetchmail_flag_buffer=flags)
+            folder = this.folder_id
+            mails = dict(
+                (mail.msgid, mail) for mail in this.mail_ids
+                if mail.object_id and mail.object_id.id > 0)
+            if not mails:
+                continue
+            with pool.connection(folder.server_id) as connection:
+                connection.select(folder.path)
+                for chunk in chunked(sorted(mails, key=int),
+                                     folder.fetch_batch_size or 100):
+                    result, msgdata = connection.uid(
+                        'FETCH', message_set(chunk), '(UID RFC822)')
+                    if result != 'OK':
+                        _logger.error(
+                            'Could not fetch %s in %s on %s',
+                            message_set(chunk), folder.path,
+                            folder.server_id.name)
+                        continue
+                    for seq, msgid, literal in parse_fetch_response(
+                            msgdata):
+                        if msgid not in mails:
+                            continue
+                        mail_message = self.pool.get('mail.thread')\
+                            .message_parse(
+                                cr, uid, literal,
+                                save_original=folder.server_id.original,
+                                context=context)
+                        folder.server_id.attach_mail(
+                            connection,
+                            mails[msgid].object_id.id, folder, mail_message,
+                            msgid
+                        )
+                flags.flush(connection)
         return {'type': 'ir.actions.act_window_close'}
 
     def fields_view_get(self, cr, user, view_id=None, view_type='form',
@@ -20,8 +20,103 @@
 ##############################################################################
 
 from openerp.osv import orm, fields
+from openerp.tools.translate import _
 
-from openerp.addons.server_environment import serv_config
+from openerp.addons.server_environment import serv_config, get_section
+
+OUTGOING_SCHEMA = {'smtp_port': int}
+OUTGOING_DEFAULTS = {'smtp_port': 587}
+INCOMING_SCHEMA = {'port': int,
+                   'is_ssl': bool,
+                   'attach': bool,
+                   'original': bool,
+                   }
+INCOMING_DEFAULTS = {'port': 993,
+                     'is_ssl': False,
+                     'attach': False,
+                     'original': False,
+                     }
+
+
+def _get_name_conf(global_section_name, record_name, schema, defaults):
+    """Return configuration for a record name"""
+    return get_section('%s.%s' % (global_section_name, record_name),
+                       schema=schema, defaults=defaults,
+                       parent=global_section_name)
+
+
+def _server_types(snapshot):
+    """Return the type configured for all incoming mail servers and
+    {server name: type} of the servers with a section of their own"""
+    prefix = 'incoming_mail.'
+    named = {}
+    for section in snapshot.sections():
+        if section.startswith(prefix):
+            named[section[len(prefix):]] = snapshot.get_section(
+                section, schema=INCOMING_SCHEMA, defaults=INCOMING_DEFAULTS,
+                parent='incoming_mail').get('type')
+    global_type = snapshot.get_section(
+        'incoming_mail', schema=INCOMING_SCHEMA,
+        defaults=INCOMING_DEFAULTS).get('type')
+    return global_type, named
+
+
+_server_types_cache = {}
+"""Result of _server_types by configuration fingerprint"""
+
+
+def _get_server_types():
+    """Return _server_types of the current configuration, computed once per
+    configuration snapshot"""
+    fingerprint = serv_config.fingerprint
+    if fingerprint not in _server_types_cache:
+        _server_types_cache.clear()
+        _server_types_cache[fingerprint] = _server_types(serv_config.snapshot)
+    return _server_types_cache[fingerprint]
+
+
+def _type_matches(server_type, operator, value):
+    """Return if a configured server type satisfies operator and value"""
+    if operator == '=':
+        return server_type == value
+    if operator == 'in':
+        return server_type in value
+    # like searching for the stored type: servers without type don't match
+    return bool(server_type) and server_type != value
+
+
+def _type_domain(server_types, operator, value):
+    """Return a domain on the server name for a search on the configured
+    type"""
+    if operator not in ('=', 'in', '!='):
+        raise orm.except_orm(
+            _('Error'),
+            _('Operator %s is not supported for the server type') %
+            operator)
+    global_type, named = server_types
+    if _type_matches(global_type, operator, value):
+        # all servers but those configured otherwise
+        return [('name', 'not in', sorted(
+            name for name, server_type in named.iteritems()
+            if not _type_matches(server_type, operator, value)))]
+    return [('name', 'in', sorted(
+        name for name, server_type in named.iteritems()
+        if _type_matches(server_type, operator, value)))]
+
+
+def _get_conf(model, cr, uid, ids, global_section_name, schema, defaults,
+              context=None):
+    """Return configuration by record id, looking up the sections only
+    once per distinct record name"""
+    res = {}
+    by_name = {}
+    for record in model.read(cr, uid, ids, ['name'], context=context):
+        record_name = record['name']
+        if record_name not in by_name:
+            by_name[record_name] = _get_name_conf(
+                global_section_name, record_name, schema, defaults)
+        res[record['id']] = dict(by_name[record_name])
+    return res
 
 
 class IrMail(orm.Model):
@@ -31,25 +126,8 @@ class IrMail(orm.Model):
         """
         Return configuration
         """
-        res = {}
-        for mail_server in self.browse(cr, uid, ids, context=context):
-            global_section_name = 'outgoing_mail'
-
-            # default vals
-            config_vals = {'smtp_port': 587}
-            if serv_config.has_section(global_section_name):
-                config_vals.update((serv_config.items(global_section_name)))
-
-            custom_section_name = '.'.join((global_section_name,
-                                            mail_server.name))
-            if serv_config.has_section(custom_section_name):
-                config_vals.update(serv_config.items(custom_section_name))
-
-            if config_vals.get('smtp_port'):
-                config_vals['smtp_port'] = int(config_vals['smtp_port'])
-
-            res[mail_server.id] = config_vals
-        return res
+        return _get_conf(self, cr, uid, ids, 'outgoing_mail',
+                         OUTGOING_SCHEMA, OUTGOING_DEFAULTS, context=context)
 
     _columns = {
         'smtp_host': fields.function(
@@ -110,60 +188,17 @@ class FetchmailServer(orm.Model):
         """
         Return configuration
         """
-        res = {}
-        for fetchmail in self.browse(cr, uid, ids, context=context):
-            global_section_name = 'incoming_mail'
-
-            key_types = {'port': int,
-                         'is_ssl': lambda a: bool(int(a)),
-                         'attach': lambda a: bool(int(a)),
-                         'original': lambda a: bool(int(a)),
-                         }
-
-            # default vals
-            config_vals = {'port': 993,
-                           'is_ssl': 0,
-                           'attach': 0,
-                           'original': 0,
-                           }
-            if serv_config.has_section(global_section_name):
-                config_vals.update(serv_config.items(global_section_name))
-
-            custom_section_name = '.'.join((global_section_name,
-                                            fetchmail.name))
-            if serv_config.has_section(custom_section_name):
-                config_vals.update(serv_config.items(custom_section_name))
-
-            for key, to_type in key_types.iteritems():
-                if config_vals.get(key):
-                    config_vals[key] = to_type(config_vals[key])
-            res[fetchmail.id] = config_vals
-        return res
+        return _get_conf(self, cr, uid, ids, 'incoming_mail',
+                         INCOMING_SCHEMA, INCOMING_DEFAULTS, context=context)
 
     def _type_search(self, cr, uid, obj, name, args, context=None):
-        result_ids = []
-        # read all incoming servers values
-        all_ids = self.search(cr, uid, [], context=context)
-        results = self.read(cr, uid, all_ids, ['id', 'type'], context=context)
-        args = args[:]
-        i = 0
-        while i < len(args):
-            operator = args[i][1]
-            if operator == '=':
-                for res in results:
-                    if (res['type'] == args[i][2] and
-                            res['id'] not in result_ids):
-                        result_ids.append(res['id'])
-            elif operator == 'in':
-                for search_vals in args[i][2]:
-                    for res in results:
-                        if (res['type'] == search_vals and
-                                res['id'] not in result_ids):
-                            result_ids.append(res['id'])
-            else:
-                continue
-            i += 1
-        return [('id', 'in', result_ids)]
+        """Search servers by the type configured for their name, without
+        reading the servers"""
+        server_types = _get_server_types()
+        domain = []
+        for arg in args:
+            domain += _type_domain(server_types, arg[1], arg[2])
+        return domain
 
     _columns = {
         'server': fields.function(
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Nicolas Bessi
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import ConfigParser
+from openerp.tests import common
+from openerp.addons.server_environment.serv_config import ConfigSnapshot
+from openerp.addons.mail_environment.env_mail import (
+    _server_types, _type_domain)
+
+
+class TestEnvMail(common.TransactionCase):
+
+    def test_type_domain(self):
+        config_p = ConfigParser.SafeConfigParser()
+        config_p.add_section('incoming_mail')
+        config_p.set('incoming_mail', 'type', 'imap')
+        config_p.add_section('incoming_mail.pop1')
+        config_p.set('incoming_mail.pop1', 'type', 'pop')
+        config_p.add_section('incoming_mail.imap1')
+        config_p.set('incoming_mail.imap1', 'port', '143')
+        server_types = _server_types(ConfigSnapshot(config_p))
+        self.assertEqual(
+            server_types, ('imap', {'pop1': 'pop', 'imap1': 'imap'}))
+        # servers without a section of their own have the global type
+        self.assertEqual(_type_domain(server_types, '=', 'imap'),
+                         [('name', 'not in', ['pop1'])])
+        self.assertEqual(_type_domain(server_types, '=', 'pop'),
+                         [('name', 'in', ['pop1'])])
+        self.assertEqual(_type_domain(server_types, 'in', ['pop', 'local']),
+                         [('name', 'in', ['pop1'])])
+        self.assertEqual(_type_domain(server_types, '!=', 'pop'),
+                         [('name', 'not in', ['pop1'])])
+        self.assertEqual(_type_domain(server_types, '!=', 'imap'),
+                         [('name', 'in', ['pop1'])])
+        # the domain finds servers
+        server = self.env['fetchmail.server'].create({'name': 'imap2'})
+        self.assertIn(
+            server,
+            self.env['fetchmail.server'].search(
+                _type_domain(server_types, '=', 'imap')))
+        with self.assertRaises(Exception):
+            _type_domain(server_types, 'like', 'imap')
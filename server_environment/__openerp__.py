@@ -75,6 +75,43 @@ Example usage
        print (key, value)
 
     serv_config.get('external_service.ftp', 'tls')
+
+The configuration is parsed once into an immutable snapshot, so lookups
+don't parse or interpolate anything. To pick up changed configuration
+files without a restart, set the number of seconds after which workers
+check the files for changes::
+
+    [options]
+    server_environment_reload_interval = 60
+
+or call `serv_config.reload()`.
+
+Configuration files may include other files with `%include <path>`,
+where the path is relative to the including file and may contain
+wildcards. An option called `<name>__file` sets option `<name>` to the
+content of the file it names, relative to the file the option is in, ie
+to keep passwords out of the configuration tree. The environment variables `SERVER_ENV_CONFIG` and
+`SERVER_ENV_CONFIG_SECRET` may contain configuration in the same format,
+which overrides the files. Files are only parsed again when they, or
+a file they include, changed, or when files matching an include pattern
+were added or removed.
+
+To see what the module costs at worker startup, set the option
+`server_environment_profile = True` or the environment variable
+`SERVER_ENV_PROFILE=1`. The time spent parsing the configuration,
+collecting system information, adding the columns and building the view
+of `server.config` is then logged, per database where it applies, and
+shown on the "Startup profile" page of the Server Environment menu.
+
+To read a section with defaults, overridden by a more general section and
+with options converted to their types, use `get_section`. The result is
+computed once per configuration snapshot::
+
+    from server_environment import get_section
+    ftp = get_section('external_service.ftp',
+                      schema={'port': int, 'tls': bool},
+                      defaults={'port': '21'},
+                      parent='external_service')
     """,
     "website": "http://www.camptocamp.com",
     "license": "GPL-3 or any later version",
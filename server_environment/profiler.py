@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Adapted by Nicolas Bessi. Copyright Camptocamp SA
+#    Based on Florent Xicluna original code. Copyright Wingo SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from openerp.tools.config import config as system_base_config
+
+_logger = logging.getLogger(__name__)
+
+_steps = []
+_steps_lock = threading.Lock()
+
+
+def enabled():
+    """Return if startup profiling is switched on, with the option
+    `server_environment_profile` or the environment variable
+    SERVER_ENV_PROFILE."""
+    value = (os.environ.get('SERVER_ENV_PROFILE') or
+             system_base_config.get('server_environment_profile') or '')
+    return str(value).lower() in ('1', 'yes', 'true', 'on')
+
+
+@contextmanager
+def step(name, dbname=None):
+    """Record the wall time of the with block as step name, if profiling
+    is enabled."""
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start, dbname=dbname)
+
+
+def record(name, seconds, dbname=None):
+    """Record and log a step which took seconds."""
+    with _steps_lock:
+        _steps.append((name, dbname, seconds))
+    _logger.info('server_environment startup: %s%s took %.1f ms',
+                 name, ' (%s)' % dbname if dbname else '', seconds * 1000)
+
+
+def get_steps():
+    """Return [(name, database or None, seconds)] of the steps recorded in
+    this process, in the order they ran."""
+    with _steps_lock:
+        return list(_steps)
+
+
+def report():
+    """Return the recorded steps as text, one line per step. Steps may
+    contain each other, ie the system information is collected while
+    computing the configuration fingerprint the first time."""
+    return '\n'.join(
+        '%-25s %-20s %10.1f ms' % (name, dbname or '', seconds * 1000)
+        for name, dbname, seconds in get_steps())
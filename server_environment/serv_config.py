@@ -19,19 +19,30 @@
 #
 ##############################################################################
 
+import glob
+import hashlib
+import logging
 import os
+import re
+import threading
+import time
 import ConfigParser
+from StringIO import StringIO
 from lxml import etree
 from itertools import chain
 
 from openerp import models, fields
 from openerp.tools.config import config as system_base_config
+from openerp.tools.lru import LRU
 
+from . import profiler
 from .system_info import get_server_environment
 
 from openerp.addons import server_environment_files
 _dir = os.path.dirname(server_environment_files.__file__)
 
+_logger = logging.getLogger(__name__)
+
 # Same dict as RawConfigParser._boolean_states
 _boolean_states = {'1': True, 'yes': True, 'true': True, 'on': True,
                    '0': False, 'no': False, 'false': False, 'off': False}
@@ -81,27 +92,383 @@ def _listconf(env_path):
     return files
 
 
-def _load_config():
-    """Load the configuration and return a ConfigParser instance."""
+def _conf_dirs():
+    """Return the folders configuration files are read from."""
     default = os.path.join(_dir, 'default')
     running_env = os.path.join(_dir,
                                system_base_config['running_env'])
     if os.path.isdir(default):
-        conf_files = _listconf(default) + _listconf(running_env)
-    else:
-        conf_files = _listconf(running_env)
+        return [default, running_env]
+    return [running_env]
 
-    config_p = ConfigParser.SafeConfigParser()
+
+ENV_LAYERS = ('SERVER_ENV_CONFIG', 'SERVER_ENV_CONFIG_SECRET')
+"""Environment variables containing configuration, applied in this order
+after the configuration files"""
+
+SECRET_FILE_SUFFIX = '__file'
+"""Options with this suffix name a file to read the option's value from"""
+
+_layer_cache = {}
+"""Parsed configuration files by path, with the modification times of the
+files they were read from"""
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+_SECRET_FILE_OPTION = re.compile(
+    r'^(?P<option>[^:=\s][^:=]*%s)\s*[:=]\s*(?P<value>.*?)\s*$' %
+    SECRET_FILE_SUFFIX)
+
+
+def _expand_includes(text, base_dir, seen):
+    """Replace `%include <path or pattern>` lines in text by the included
+    files' contents, and make secret file references absolute relative to
+    the file they are in. Return the text and the fingerprint of the
+    included files: ('file', path, mtime) for every file and
+    ('glob', pattern, paths) for every pattern, to notice new matches."""
+    lines = []
+    fingerprint = []
+    for line in text.splitlines(True):
+        if not line.startswith('%include'):
+            match = _SECRET_FILE_OPTION.match(line)
+            if match:
+                line = '%s = %s\n' % (
+                    match.group('option'), os.path.join(
+                        base_dir, os.path.expanduser(match.group('value'))))
+            lines.append(line)
+            continue
+        pattern = os.path.join(
+            base_dir, os.path.expanduser(line[len('%include'):].strip()))
+        paths = sorted(glob.glob(pattern))
+        if glob.has_magic(pattern):
+            fingerprint.append(('glob', pattern, tuple(paths)))
+        elif not paths:
+            raise Exception('Cannot include %s: no such file' % pattern)
+        for path in paths:
+            if path in seen:
+                raise Exception('Recursive %%include of %s' % path)
+            with open(path) as f:
+                included, included_fingerprint = _expand_includes(
+                    f.read(), os.path.dirname(path), seen + [path])
+            lines.append(included.rstrip('\n') + '\n')
+            fingerprint += [('file', path, _mtime(path))] +\
+                included_fingerprint
+    return ''.join(lines), fingerprint
+
+
+def _unchanged(fingerprint):
+    """Return if the files of a layer fingerprint are unchanged."""
+    for kind, name, value in fingerprint:
+        if kind == 'file' and _mtime(name) != value:
+            return False
+        if kind == 'glob' and tuple(sorted(glob.glob(name))) != value:
+            return False
+    return True
+
+
+def _parse_layer(text, name, base_dir):
+    """Parse a layer's text, return {section: {option: raw value}} and the
+    fingerprint of the files included."""
+    parser = ConfigParser.RawConfigParser()
     # options are case-sensitive
-    config_p.optionxform = str
+    parser.optionxform = str
+    text, fingerprint = _expand_includes(text, base_dir, [name])
     try:
-        config_p.read(conf_files)
+        parser.readfp(StringIO(text), name)
     except Exception as e:
-        raise Exception('Cannot read config files "%s":  %s' % (conf_files, e))
-
+        raise Exception('Cannot read config "%s":  %s' % (name, e))
+    sections = {'DEFAULT': dict(parser.defaults())}
+    for section in parser.sections():
+        sections[section] = dict(
+            (option, value)
+            for option, value in parser._sections[section].items()
+            if option != '__name__')
+    return sections, fingerprint
+
+
+def _file_layer(path):
+    """Return (fingerprint, sections) of a configuration file, parsing it
+    only if it or one of its includes changed since the last time."""
+    cached = _layer_cache.get(path)
+    if cached is not None and _unchanged(cached[0]):
+        return cached
+    mtime = _mtime(path)
+    with open(path) as f:
+        sections, fingerprint = _parse_layer(
+            f.read(), path, os.path.dirname(path))
+    layer = (tuple([('file', path, mtime)] + fingerprint), sections)
+    _layer_cache[path] = layer
+    return layer
+
+
+def _env_layer(variable):
+    """Return (fingerprint, sections) of configuration in an environment
+    variable, or None if it isn't set."""
+    text = os.environ.get(variable)
+    if not text:
+        return None
+    cached = _layer_cache.get(variable)
+    if cached is not None and cached[2] == text and\
+            _unchanged(cached[0][1:]):
+        return cached[:2]
+    sections, fingerprint = _parse_layer(text, variable, os.getcwd())
+    fingerprint = tuple(
+        [('env', variable, hashlib.sha1(text).hexdigest())] + fingerprint)
+    _layer_cache[variable] = (fingerprint, sections, text)
+    return fingerprint, sections
+
+
+def _layers():
+    """Return [(fingerprint, sections)] of all configuration layers: the
+    files in default/, the files in the running environment's folder and
+    the environment variables in ENV_LAYERS"""
+    layers = []
+    for conf_dir in _conf_dirs():
+        layers += [_file_layer(path) for path in _listconf(conf_dir)]
+    for variable in ENV_LAYERS:
+        layer = _env_layer(variable)
+        if layer is not None:
+            layers.append(layer)
+    return layers
+
+
+def _secret_files(layers):
+    return sorted(set(
+        value for fingerprint, sections in layers
+        for values in sections.itervalues()
+        for option, value in values.iteritems()
+        if option.endswith(SECRET_FILE_SUFFIX)))
+
+
+def _fingerprint(layers=None):
+    """Return the modification times of all configuration layers and
+    secret files, which change when one of them changes."""
+    layers = _layers() if layers is None else layers
+    return (tuple(fingerprint for fingerprint, sections in layers) +
+            tuple((path, _mtime(path)) for path in _secret_files(layers)))
+
+
+def _load_config(layers=None):
+    """Merge the configuration layers and return a ConfigParser instance."""
+    layers = _layers() if layers is None else layers
+    config_p = ConfigParser.SafeConfigParser()
+    # options are case-sensitive
+    config_p.optionxform = str
+    for fingerprint, sections in layers:
+        for section, values in sorted(sections.iteritems()):
+            if section == 'DEFAULT':
+                target = config_p.defaults()
+            else:
+                if not config_p.has_section(section):
+                    config_p.add_section(section)
+                target = config_p._sections[section]
+            for option, value in values.iteritems():
+                if option.endswith(SECRET_FILE_SUFFIX):
+                    with open(value) as f:
+                        # secrets are taken literally, not interpolated
+                        value = f.read().rstrip('\r\n').replace('%', '%%')
+                    option = option[:-len(SECRET_FILE_SUFFIX)]
+                target[option] = value
     return config_p
 
-serv_config = _load_config()
+
+class ConfigSnapshot(object):
+    """Immutable, already interpolated copy of a configuration.
+
+    Offers the reading part of the ConfigParser API, lookups are
+    dictionary lookups.
+    """
+    __slots__ = ('_sections', '_items', '_section_cache', 'fingerprint')
+
+    def __init__(self, config_p, fingerprint=None):
+        sections = {}
+        items = {}
+        for section in config_p.sections():
+            section_items = tuple(config_p.items(section))
+            items[section] = section_items
+            sections[section] = dict(section_items)
+        object.__setattr__(self, '_sections', sections)
+        object.__setattr__(self, '_items', items)
+        object.__setattr__(self, 'fingerprint', fingerprint)
+        object.__setattr__(self, '_section_cache', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConfigSnapshot is immutable')
+
+    def sections(self):
+        return sorted(self._sections)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def options(self, section):
+        return [key for key, value in self.items(section)]
+
+    def has_option(self, section, option):
+        return option in self._sections.get(section, ())
+
+    def items(self, section, raw=False, vars=None):
+        """Like ConfigParser.items. Values are interpolated already, so
+        raw makes no difference."""
+        try:
+            items = list(self._items[section])
+        except KeyError:
+            raise ConfigParser.NoSectionError(section)
+        if vars:
+            items = [(key, value) for key, value in items
+                     if key not in vars] + sorted(vars.items())
+        return items
+
+    def get(self, section, option, raw=False, vars=None):
+        """Like ConfigParser.get, options in vars take precedence."""
+        try:
+            values = self._sections[section]
+        except KeyError:
+            raise ConfigParser.NoSectionError(section)
+        if vars and option in vars:
+            return vars[option]
+        try:
+            return values[option]
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, section)
+
+    def getint(self, section, option):
+        return int(self.get(section, option))
+
+    def getfloat(self, section, option):
+        return float(self.get(section, option))
+
+    def getboolean(self, section, option):
+        value = self.get(section, option)
+        if value.lower() not in _boolean_states:
+            raise ValueError('Not a boolean: %s' % value)
+        return _boolean_states[value.lower()]
+
+    def get_section(self, name, schema=None, defaults=None, parent=None):
+        """Return the options of section name as a dict.
+
+        Options come from defaults, overridden by the section parent, ie a
+        global section, overridden by section name. Options in schema, a
+        dict of option name and type, are converted to that type. The
+        result is computed once per snapshot.
+        """
+        try:
+            key = (name, parent,
+                   tuple(sorted((schema or {}).items())),
+                   tuple(sorted((defaults or {}).items())))
+            hash(key)
+        except TypeError:
+            key = None
+        if key is not None and key in self._section_cache:
+            return dict(self._section_cache[key])
+        values = dict(defaults or {})
+        for section in (parent, name):
+            if section and section in self._sections:
+                values.update(self._sections[section])
+        for option, option_type in (schema or {}).iteritems():
+            if option in values:
+                values[option] = _cast(
+                    values[option], option_type, name, option)
+        if key is not None:
+            self._section_cache[key] = values
+        return dict(values)
+
+
+def _cast(value, option_type, section, option):
+    """Convert a configuration value to option_type. Empty values are
+    left as they are, like `port =`."""
+    if value is None or value == '' or isinstance(value, option_type):
+        return value
+    try:
+        if option_type is bool:
+            return _boolean_states[str(value).lower()]
+        return option_type(value)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Option %s in section %s is not a valid %s: %r' % (
+            option, section, option_type.__name__, value))
+
+
+def get_section(name, schema=None, defaults=None, parent=None):
+    """Return the options of a section of the current configuration, see
+    ConfigSnapshot.get_section."""
+    return serv_config.get_section(
+        name, schema=schema, defaults=defaults, parent=parent)
+
+
+class _ServConfig(object):
+    """The current ConfigSnapshot of the environment configuration.
+
+    Attribute access is delegated to the snapshot. If the option
+    `server_environment_reload_interval` is set to a number of seconds,
+    the configuration files are checked for changes at most that often,
+    and the snapshot is replaced when they changed. Every worker process
+    does so on its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = time.time()
+        with profiler.step('config parse'):
+            layers = _layers()
+            self.snapshot = ConfigSnapshot(
+                _load_config(layers), _fingerprint(layers))
+
+    def reload(self, force=False):
+        """Replace the snapshot if the configuration files changed, or if
+        force is set. Return if the snapshot was replaced."""
+        with self._lock:
+            self._checked = time.time()
+            layers = _layers()
+            fingerprint = _fingerprint(layers)
+            if not force and fingerprint == self.snapshot.fingerprint:
+                return False
+            self.snapshot = ConfigSnapshot(_load_config(layers), fingerprint)
+        _logger.info('Reloaded server environment configuration')
+        return True
+
+    def _check_reload(self):
+        interval = float(
+            system_base_config.get('server_environment_reload_interval') or
+            0)
+        if interval > 0 and time.time() - self._checked >= interval:
+            try:
+                self.reload()
+            except Exception:
+                _logger.exception(
+                    'Could not reload server environment configuration')
+
+    def __getattr__(self, name):
+        self._check_reload()
+        return getattr(self.snapshot, name)
+
+
+serv_config = _ServConfig()
+
+
+def _config_fingerprint():
+    """Return a hash of everything the server.config model and view are
+    built from."""
+    return hashlib.sha1(repr((
+        sorted(system_base_config.options.items()),
+        system_base_config.rcfile,
+        [(section, serv_config.items(section))
+         for section in serv_config.sections()],
+        get_server_environment(),
+        profiler.enabled(),
+    ))).hexdigest()
+
+
+_arch_cache = {}
+"""Generated form archs by configuration fingerprint"""
+
+_view_cache = LRU(64)
+"""Post processed form views by (fingerprint, database, language)"""
 
 
 class _Defaults(dict):
@@ -117,18 +484,24 @@ class ServerConfiguration(models.TransientModel):
     _name = 'server.config'
     _conf_defaults = _Defaults()
 
+    startup_profile = fields.Text(readonly=True)
+
     def __init__(self, pool, cr):
         """Add columns to model dynamically
         and init some properties
 
         """
-        self._add_columns()
+        with profiler.step('config fingerprint', cr.dbname):
+            self._fingerprint = _config_fingerprint()
+        with profiler.step('column injection', cr.dbname):
+            self._add_columns()
         super(ServerConfiguration, self).__init__(pool, cr)
         self.running_env = system_base_config['running_env']
         # Only show passwords in development
         self.show_passwords = self.running_env in ('dev',)
         self._arch = None
-        self._build_osv()
+        with profiler.step('view build', cr.dbname):
+            self._build_osv()
 
     def _format_key(self, section, key):
         return '%s | %s' % (section, key)
@@ -142,9 +515,12 @@ class ServerConfiguration(models.TransientModel):
         )
         for col, value in cols:
             col_name = col.replace('.', '_')
-            setattr(ServerConfiguration,
-                    col_name,
-                    fields.Char(string=col, readonly=True))
+            # fields are shared by all registries of the process
+            if not isinstance(getattr(ServerConfiguration, col_name, None),
+                              fields.Char):
+                setattr(ServerConfiguration,
+                        col_name,
+                        fields.Char(string=col, readonly=True))
             self._conf_defaults[col_name] = value
 
     def _get_base_cols(self):
@@ -185,7 +561,14 @@ class ServerConfiguration(models.TransientModel):
                 '</group>')
 
     def _build_osv(self):
-        """Build the view for the current configuration."""
+        """Build the view for the current configuration, once per process
+        and configuration."""
+        if self._fingerprint not in _arch_cache:
+            _arch_cache[self._fingerprint] = self._build_arch()
+        self._arch = etree.fromstring(_arch_cache[self._fingerprint])
+
+    def _build_arch(self):
+        """Return the arch of the view for the current configuration."""
         arch = ('<?xml version="1.0" encoding="utf-8"?>'
                 '<form string="Configuration Form">'
                 '<notebook colspan="4">')
@@ -211,8 +594,14 @@ class ServerConfiguration(models.TransientModel):
         arch += self._group(self._get_system_cols())
         arch += '<separator colspan="4"/></page>'
 
+        if profiler.enabled():
+            arch += '<page string="Startup profile">'
+            arch += ('<field name="startup_profile" nolabel="1" '
+                     'colspan="4" readonly="1"/>')
+            arch += '</page>'
+
         arch += '</notebook></form>'
-        self._arch = etree.fromstring(arch)
+        return arch
 
     def fields_view_get(self, cr, uid, view_id=None, view_type='form',
                         context=None, toolbar=False, submenu=False):
@@ -223,13 +612,20 @@ class ServerConfiguration(models.TransientModel):
                                                                context,
                                                                toolbar)
         if view_type == 'form':
-            arch_node = self._arch
-            xarch, xfields = self._view_look_dom_arch(cr, uid,
-                                                      arch_node,
-                                                      view_id,
-                                                      context=context)
+            key = (self._fingerprint, cr.dbname,
+                   (context or {}).get('lang'))
+            try:
+                xarch, xfields = _view_cache[key]
+            except KeyError:
+                arch_node = self._arch
+                xarch, xfields = self._view_look_dom_arch(cr, uid,
+                                                          arch_node,
+                                                          view_id,
+                                                          context=context)
+                _view_cache[key] = (xarch, xfields)
             res['arch'] = xarch
-            res['fields'] = xfields
+            res['fields'] = dict(
+                (name, dict(value)) for name, value in xfields.iteritems())
         return res
 
     def default_get(self, cr, uid, fields_list, context=None):
@@ -239,4 +635,6 @@ class ServerConfiguration(models.TransientModel):
                 res[key] = '**********'
             else:
                 res[key] = self._conf_defaults[key]()
+        if profiler.enabled():
+            res['startup_profile'] = profiler.report()
         return res
@@ -22,35 +22,126 @@
 import locale
 import os
 import platform
-import subprocess
+import threading
 
 from openerp import release
 from openerp.tools.config import config
 
+from . import profiler
 
-def _get_output(cmd):
-    bindir = config['root_path']
-    p = subprocess.Popen(cmd, shell=True, cwd=bindir, stdout=subprocess.PIPE)
-    return p.communicate()[0].rstrip()
+_cache = None
+_cache_lock = threading.Lock()
 
 
-def get_server_environment():
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _find_up(path, name):
+    """Return the first `name` found in path or one of its parents."""
+    path = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(path, name)
+        if os.path.exists(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _git_revision(path):
+    """Read the commit checked out in the git repository containing path,
+    without running git."""
+    git_dir = _find_up(path, '.git')
+    if not git_dir:
+        return None
+    if os.path.isfile(git_dir):
+        # worktrees and submodules: "gitdir: <path>"
+        content = _read(git_dir)
+        if not content.startswith('gitdir:'):
+            return None
+        git_dir = os.path.join(os.path.dirname(git_dir),
+                               content[len('gitdir:'):].strip())
+    head = _read(os.path.join(git_dir, 'HEAD'))
+    if not head.startswith('ref:'):
+        return head
+    ref = head[len('ref:'):].strip()
+    common_dir = git_dir
+    if os.path.exists(os.path.join(git_dir, 'commondir')):
+        common_dir = os.path.join(
+            git_dir, _read(os.path.join(git_dir, 'commondir')))
+    for base in (git_dir, common_dir):
+        if os.path.exists(os.path.join(base, ref)):
+            return _read(os.path.join(base, ref))
+    packed_refs = os.path.join(common_dir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    return None
+
+
+def _bzr_revision(path):
+    """Read the last revision of the bzr branch containing path."""
+    bzr_dir = _find_up(path, '.bzr')
+    if not bzr_dir:
+        return None
+    last_revision = os.path.join(bzr_dir, 'branch', 'last-revision')
+    if not os.path.exists(last_revision):
+        return None
+    return _read(last_revision)
+
+
+def _os_release(path='/etc/os-release'):
+    """Parse os-release(5) into a dict."""
+    result = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            if value[:1] in ('"', "'") and value[-1:] == value[:1]:
+                value = value[1:-1].decode('string_escape')
+            result[key] = value
+    return result
+
+
+def _compute_server_environment():
     # inspired by server/bin/service/web_services.py
+    bindir = config['root_path']
+    rev_id = None
     try:
-        rev_id = 'git:%s' % _get_output('git rev-parse HEAD')
+        rev_id = _git_revision(bindir)
+        if rev_id:
+            rev_id = 'git:%s' % rev_id
+        else:
+            rev_id = _bzr_revision(bindir)
+            if rev_id:
+                rev_id = 'bzr: %s' % rev_id
     except Exception:
-        try:
-            rev_id = 'bzr: %s' % _get_output('bzr revision-info')
-        except Exception:
-            rev_id = 'Can not retrive revison from git or bzr'
+        rev_id = None
+    if not rev_id:
+        rev_id = 'Can not retrive revison from git or bzr'
 
     os_lang = '.'.join([x for x in locale.getdefaultlocale() if x])
     if not os_lang:
         os_lang = 'NOT SET'
+    lsbinfo = 'not lsb compliant'
     if os.name == 'posix' and platform.system() == 'Linux':
-        lsbinfo = _get_output('lsb_release -a')
-    else:
-        lsbinfo = 'not lsb compliant'
+        try:
+            os_release = _os_release()
+            lsbinfo = os_release.get('PRETTY_NAME') or ' '.join(
+                [os_release.get('NAME', ''), os_release.get('VERSION', '')]
+            ).strip() or lsbinfo
+        except (IOError, OSError):
+            pass
     return (
         ('platform', platform.platform()),
         ('os.name', os.name),
@@ -63,3 +154,22 @@ def get_server_environment():
         ('openerp', release.version),
         ('revision', rev_id),
     )
+
+
+def get_server_environment():
+    """Return information about the system, collected once per process."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                with profiler.step('system info'):
+                    _cache = _compute_server_environment()
+    return _cache
+
+
+def refresh_server_environment():
+    """Collect the system information again and return it."""
+    global _cache
+    with _cache_lock:
+        _cache = _compute_server_environment()
+    return _cache
@@ -18,8 +18,16 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+import os
+import shutil
+import tempfile
 from openerp.tests import common
-from openerp.addons.server_environment import serv_config
+from openerp.addons.server_environment import serv_config, get_section
+from openerp.addons.server_environment import profiler
+from openerp.addons.server_environment.serv_config import (
+    ConfigSnapshot, _file_layer, _load_config)
+from openerp.addons.server_environment.system_info import (
+    get_server_environment, refresh_server_environment)
 
 
 class TestEnv(common.TransactionCase):
@@ -28,6 +36,10 @@ class TestEnv(common.TransactionCase):
         model = self.env['server.config']
         view = model.fields_view_get()
         self.assertTrue(view)
+        # the second time, the view comes from the cache
+        cached = model.fields_view_get()
+        self.assertIs(cached['arch'], view['arch'])
+        self.assertEqual(cached['fields'], view['fields'])
 
     def test_default(self):
         model = self.env['server.config']
@@ -46,3 +58,101 @@ class TestEnv(common.TransactionCase):
     def test_value_retrival(self):
         val = serv_config.get('external_service.ftp', 'user')
         self.assertEqual(val, 'toto')
+
+    def test_snapshot(self):
+        snapshot = serv_config.snapshot
+        self.assertEqual(snapshot.get('external_service.ftp', 'user'), 'toto')
+        self.assertIn(('user', 'toto'), snapshot.items('external_service.ftp'))
+        with self.assertRaises(AttributeError):
+            snapshot.fingerprint = None
+        self.assertFalse(serv_config.reload())
+        self.assertTrue(serv_config.reload(force=True))
+        self.assertIsNot(serv_config.snapshot, snapshot)
+        self.assertEqual(serv_config.get('external_service.ftp', 'user'),
+                         'toto')
+        # ConfigParser's keyword arguments are accepted
+        self.assertEqual(
+            serv_config.get('external_service.ftp', 'user', raw=True,
+                            vars={'user': 'titi'}),
+            'titi')
+        self.assertIn(
+            ('other', 'value'),
+            serv_config.items('external_service.ftp', raw=True,
+                              vars={'other': 'value'}))
+
+    def test_system_info(self):
+        info = get_server_environment()
+        self.assertIs(get_server_environment(), info)
+        self.assertEqual(dict(info).keys(), dict(
+            refresh_server_environment()).keys())
+        self.assertIsNot(get_server_environment(), info)
+
+    def test_get_section(self):
+        schema = {'port': int, 'tls': bool, 'timeout': int}
+        section = get_section(
+            'external_service.ftp', schema=schema,
+            defaults={'timeout': '30', 'user': 'nobody'},
+            parent='external_service')
+        self.assertEqual(section['user'], 'toto')
+        self.assertIs(section['tls'], False)
+        self.assertIsInstance(section['port'], int)
+        self.assertEqual(section['timeout'], 30)
+        self.assertEqual(section['CONSTA'], 'D01')
+        # results are cached, but callers get their own copy
+        section['user'] = 'changed'
+        self.assertEqual(
+            get_section('external_service.ftp', schema=schema,
+                        defaults={'timeout': '30', 'user': 'nobody'},
+                        parent='external_service')['user'],
+            'toto')
+        self.assertEqual(get_section('no such section'), {})
+        # empty values are not converted
+        self.assertEqual(
+            get_section('no such section', schema={'port': int, 'tls': bool},
+                        defaults={'port': '', 'tls': ''}),
+            {'port': '', 'tls': ''})
+
+    def test_layers(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmp, 'inc'))
+            with open(os.path.join(tmp, 'main.conf'), 'w') as f:
+                f.write('[ftp]\nuser = toto\n%include inc/*.inc\n')
+            # secret files are relative to the file referring to them
+            with open(os.path.join(tmp, 'inc', 'secrets.inc'), 'w') as f:
+                f.write('password__file = password.txt\n')
+            with open(os.path.join(tmp, 'inc', 'password.txt'), 'w') as f:
+                f.write('s3%(cret\n')
+            layer = _file_layer(os.path.join(tmp, 'main.conf'))
+            self.assertIs(_file_layer(os.path.join(tmp, 'main.conf')), layer)
+            overlay = ('env', {'ftp': {'user': 'titi'}})
+            config_p = _load_config([layer, overlay])
+            self.assertEqual(config_p.get('ftp', 'user'), 'titi')
+            self.assertEqual(config_p.get('ftp', 'password'), 's3%(cret')
+            snapshot = ConfigSnapshot(config_p)
+            self.assertEqual(snapshot.get('ftp', 'password'), 's3%(cret')
+            # new files matching an include pattern are picked up
+            with open(os.path.join(tmp, 'inc', 'port.inc'), 'w') as f:
+                f.write('port = 21\n')
+            layer = _file_layer(os.path.join(tmp, 'main.conf'))
+            self.assertEqual(
+                _load_config([layer]).get('ftp', 'port'), '21')
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_profiler(self):
+        steps = len(profiler.get_steps())
+        os.environ.pop('SERVER_ENV_PROFILE', None)
+        with profiler.step('test step'):
+            pass
+        self.assertEqual(len(profiler.get_steps()), steps)
+        os.environ['SERVER_ENV_PROFILE'] = '1'
+        try:
+            with profiler.step('test step', self.cr.dbname):
+                pass
+            defaults = self.env['server.config'].default_get([])
+        finally:
+            del os.environ['SERVER_ENV_PROFILE']
+        name, dbname, seconds = profiler.get_steps()[-1]
+        self.assertEqual((name, dbname), ('test step', self.cr.dbname))
+        self.assertIn('test step', defaults['startup_profile'])